@@ -36,16 +36,70 @@ def get_version():
         print(error)
     return version
 
+def is_true(name):
+    """
+    boolize environment variable
+    """
+    return environ.get(name, '').lower() in ['1', 'true', 'yes']
+
 class Config:
     TITLE = 'doko3000'
     # to be given by environment variable
     SECRET_KEY = environ.get('SECRET_KEY') or 'dummykey'
     # database
+    # storage backend - 'couchdb' or 'sqlite' for single-node installations without CouchDB
+    DATABASE_BACKEND = (environ.get('DATABASE_BACKEND') or 'couchdb').lower()
+    # file used by SQLite backend
+    SQLITE_PATH = environ.get('SQLITE_PATH') or 'doko3000.sqlite'
     # CouchDB, according to https://hub.docker.com/_/couchdb
     COUCHDB_URL = environ.get('COUCHDB_URL') or 'http://couchdb:5984'
     COUCHDB_DATABASE = environ.get('COUCHDB_DATABASE') or 'doko3000'
     COUCHDB_USER = environ.get('COUCHDB_USER') or 'admin'
     COUCHDB_PASSWORD = environ.get('COUCHDB_PASSWORD') or 'doko3000'
+    # seconds to wait for CouchDB connecting and answering
+    COUCHDB_CONNECT_TIMEOUT = float(environ.get('COUCHDB_CONNECT_TIMEOUT') or 5)
+    COUCHDB_READ_TIMEOUT = float(environ.get('COUCHDB_READ_TIMEOUT') or 10)
+    # failed writes are tried again that often, first after this many seconds, then twice as long every time
+    STORAGE_RETRIES = int(environ.get('STORAGE_RETRIES') or 3)
+    STORAGE_RETRY_DELAY = float(environ.get('STORAGE_RETRY_DELAY') or 0.1)
+    # after that many failed writes in a row storage is left alone for some seconds and game runs from memory
+    STORAGE_FAILURE_THRESHOLD = int(environ.get('STORAGE_FAILURE_THRESHOLD') or 5)
+    STORAGE_RESET_TIMEOUT = float(environ.get('STORAGE_RESET_TIMEOUT') or 30)
+    # number of old revisions CouchDB keeps per document - 0 leaves database setting as it is
+    COUCHDB_REVS_LIMIT = int(environ.get('COUCHDB_REVS_LIMIT') or 0)
+    # store tricks inside their round document instead of 12 extra documents per table
+    EMBED_TRICKS = is_true('EMBED_TRICKS')
+    # optional write-behind mode - changes go to a local journal first and reach CouchDB in background
+    WRITE_BEHIND = is_true('WRITE_BEHIND')
+    WRITE_BEHIND_JOURNAL = environ.get('WRITE_BEHIND_JOURNAL') or 'doko3000.journal'
+    # seconds between background writes to CouchDB
+    WRITE_BEHIND_INTERVAL = float(environ.get('WRITE_BEHIND_INTERVAL') or 0.5)
+    # follow CouchDB _changes feed to see changes of other processes sharing the same database
+    CHANGES_FEED = is_true('CHANGES_FEED')
+    # seconds between polls of _changes feed
+    CHANGES_INTERVAL = float(environ.get('CHANGES_INTERVAL') or 1)
+    # socket.io message queue like redis://redis:6379 - needed by several processes to reach all clients
+    MESSAGE_QUEUE = environ.get('MESSAGE_QUEUE')
+    # seconds after which rounds of tables without connected players are dropped from memory - 0 keeps all
+    TABLE_IDLE_TIMEOUT = int(environ.get('TABLE_IDLE_TIMEOUT') or 0)
+    # snapshot file of game objects for fast restarts - not used if not set
+    SNAPSHOT_PATH = environ.get('SNAPSHOT_PATH') or ''
+    # seconds between periodic snapshots, additionally one is saved at shutdown
+    SNAPSHOT_INTERVAL = int(environ.get('SNAPSHOT_INTERVAL') or 300)
+    # seconds between checks if storage needs compaction - 0 disables them
+    COMPACTION_INTERVAL = int(environ.get('COMPACTION_INTERVAL') or 600)
+    # compact if more than this share of the file is not used by live data anymore...
+    COMPACTION_FRAGMENTATION = float(environ.get('COMPACTION_FRAGMENTATION') or 0.5)
+    # ...or if that many documents were written since last compaction - 0 ignores writes
+    COMPACTION_WRITES = int(environ.get('COMPACTION_WRITES') or 100000)
+    # seconds the eventlet hub may be blocked before complaining - for debugging only, 0 disables it
+    BLOCKING_DETECTION = float(environ.get('BLOCKING_DETECTION') or 0)
+    # send small state changes instead of rendered HTML for every played card and trick, clients render them
+    STATE_DELTAS = is_true('STATE_DELTAS')
+    # seconds to collect changes of lobby lists before pushing them together to all clients in lobby
+    LOBBY_DEBOUNCE = float(environ.get('LOBBY_DEBOUNCE') or 0.2)
+    # seconds a complete trick stays on the table before rules give it to its winner
+    TRICK_DELAY = float(environ.get('TRICK_DELAY') or 1.5)
     # needed for CORS in flask-socketio
     host = environ.get('HOST')
     if host:
@@ -53,13 +107,8 @@ class Config:
     else:
         CORS_ALLOWED_ORIGINS = []
     # boolize DEBUG environment variable
-    if environ.get('DEBUG') and \
-            environ['DEBUG'].lower() in ['1', 'true', 'yes']:
-        DEBUG = True
-        ENV = 'development'
-    else:
-        DEBUG = False
-        ENV = 'production'
+    DEBUG = is_true('DEBUG')
+    ENV = 'development' if DEBUG else 'production'
     # avoid browser warnings about samesite missing
     SESSION_COOKIE_SAMESITE = 'Strict'
     SESSION_COOKIE_SECURE = True
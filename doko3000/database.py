@@ -1,20 +1,128 @@
-# access to CouchDB
+# access to storage backends - CouchDB or SQLite
+
+from collections import deque
+from contextlib import contextmanager
+from hashlib import md5
+from json import dumps, \
+    loads
+from os import fsync, \
+    replace
+from pathlib import Path
+import sqlite3
+from threading import local, \
+    Lock, \
+    RLock
+from time import sleep, \
+    time
+from uuid import uuid4
 
 from cloudant import CouchDB
+from eventlet import debug as eventlet_debug, \
+    patcher
 from cloudant.document import Document
-from cloudant.query import Query
+from requests.exceptions import HTTPError, \
+    RequestException
 
+# game documents are recognized by the prefix of their IDs, e.g. 'player-1' or 'trick-table-1-3'
+DOCUMENT_TYPES = ('player', 'table', 'round', 'trick')
 
-class DB:
+
+def check_cooperative_io(async_mode, blocking_detection=0):
     """
-    database connection and queries
+    in eventlet mode storage I/O only lets other tables play while waiting if sockets and threads are patched
+    optionally complain about anything blocking the hub longer than blocking_detection seconds
+    """
+    if async_mode != 'eventlet':
+        return True
+    unpatched = [x for x in ['socket', 'select', 'thread'] if not patcher.is_monkey_patched(x)]
+    if unpatched:
+        print('ERROR', f'eventlet did not patch {", ".join(unpatched)} - every storage access blocks all tables, '
+                       'eventlet.monkey_patch() has to be called before importing doko3000')
+        return False
+    if blocking_detection:
+        eventlet_debug.hub_blocking_detection(True, resolution=blocking_detection)
+    return True
+
+
+def is_retryable(error):
+    """
+    connection problems, timeouts, conflicts and server errors might vanish when trying again
+    """
+    if isinstance(error, HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 409
+    return isinstance(error, (RequestException, sqlite3.OperationalError))
+
+
+class StorageUnavailable(Exception):
+    """
+    storage could not be reached for reading something which is not in memory
+    """
+
+
+class CircuitBreaker:
+    """
+    stop hammering unreachable storage - after too many failures in a row it opens
+    after reset_timeout seconds one attempt may check if storage is back
     """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = ''
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """
+        check if storage may be accessed
+        """
+        return self.state != 'open'
+
+    def success(self):
+        if self.opened_at is not None:
+            print('INFO', 'storage reachable again, circuit breaker closed')
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, error):
+        self.failures += 1
+        # only the kind of error - details might tell too much about the setup and are logged anyway
+        self.last_error = type(error).__name__
+        # a failed check in half-open state opens it again at once
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                print('ERROR', f'storage failed {self.failures} times in a row, circuit breaker opened')
+            self.opened_at = time()
+
+    def status(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'opened_at': int(self.opened_at) if self.opened_at else None,
+                'last_error': self.last_error}
+
+
+class CouchDBBackend:
+    """
+    documents stored in CouchDB via cloudant
+    """
+    # other processes sharing the database can be followed
+    changes_feed = True
+
     def __init__(self, app):
         self.couch = CouchDB(app.config['COUCHDB_USER'],
                              app.config['COUCHDB_PASSWORD'],
                              url=app.config['COUCHDB_URL'],
                              connect=True,
-                             auto_renew=True)
+                             auto_renew=True,
+                             timeout=(app.config.get('COUCHDB_CONNECT_TIMEOUT'),
+                                      app.config.get('COUCHDB_READ_TIMEOUT')))
         # if not existing create needed databases
         if app.config['COUCHDB_DATABASE'] not in self.couch.all_dbs():
             self.database = self.couch.create_database(app.config['COUCHDB_DATABASE'])
@@ -25,39 +133,881 @@ class DB:
         if '_users' not in self.couch:
             self.couch.create_database('_users')
 
-    def filter_by_type_as_number(self, filter_type):
+        # fewer old revisions kept means less to carry around until compaction
+        if app.config.get('COUCHDB_REVS_LIMIT'):
+            try:
+                response = self.database.r_session.put(f'{self.database.database_url}/_revs_limit',
+                                                       data=str(app.config['COUCHDB_REVS_LIMIT']))
+                response.raise_for_status()
+            except Exception as error:
+                print('ERROR', self.database.database_url, '_revs_limit')
+                print(error)
+
+    @property
+    def url(self):
+        return self.database.database_url
+
+    def iterate_documents(self, prefix='', include_docs=True, page_size=1000):
+        """
+        walk through _all_docs page by page, sorted by ID, optionally limited to IDs starting with prefix
+        yields document IDs and documents, the latter None without include_docs
+        """
+        start_key = prefix
+        while True:
+            params = {'include_docs': include_docs,
+                      # one more than needed to know where the next page starts
+                      'limit': page_size + 1}
+            if start_key:
+                params['startkey'] = start_key
+            if prefix:
+                params['endkey'] = f'{prefix}\ufff0'
+            rows = self.database.all_docs(**params)['rows']
+            for row in rows[:page_size]:
+                yield row['id'], row.get('doc')
+            if len(rows) <= page_size:
+                break
+            start_key = rows[page_size]['id']
+
+    def load_document(self, document_id):
+        """
+        retrieves one single document, None if it does not exist
+        """
+        document = Document(self.database, document_id)
+        try:
+            document.fetch()
+        except HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return None
+            raise
+        return dict(document)
+
+    def revisions(self, document_ids):
         """
-        retrieves documents filtered by type and ordered by non-document-id as number for tricks and rounds
+        current revisions of existing documents
         """
         result = {}
-        for item in Query(self.database, selector={'type': filter_type}).result:
-            item_id = item['_id'].split(f'{filter_type}-', 1)[1]
-            result[item_id] = item
+        for row in self.database.all_docs(keys=document_ids)['rows']:
+            if row.get('value') and not row['value'].get('deleted'):
+                result[row['key']] = row['value']['rev']
         return result
 
-    def filter_by_type_real_id(self, filter_type):
+    def update_seq(self):
         """
-        retrieves documents filtered by type and ordered by document-id, needed for tables and players
+        current sequence of database, starting point for following its changes
         """
-        result = {}
-        for item in Query(self.database, selector={'type': filter_type}).result:
-            result[item['_id']] = item
+        return self.database.metadata()['update_seq']
+
+    def changes(self, since):
+        """
+        documents changed since given sequence and the sequence to continue with
+        """
+        response = self.database.r_session.get(f'{self.database.database_url}/_changes',
+                                               params={'since': since,
+                                                       'include_docs': 'true',
+                                                       'style': 'main_only'})
+        response.raise_for_status()
+        data = response.json()
+        return data['results'], data['last_seq']
+
+    def save_documents(self, documents):
+        """
+        write multiple documents with one single _bulk_docs request
+        results come in the same order as the documents were sent
+        """
+        return self.database.bulk_docs(documents)
+
+    def stats(self):
+        """
+        file size versus size of live data to know about fragmentation
+        """
+        metadata = self.database.metadata()
+        sizes = metadata.get('sizes', {})
+        # older CouchDB versions only know disk_size and data_size
+        return {'file_size': sizes.get('file', metadata.get('disk_size', 0)),
+                'data_size': sizes.get('active', metadata.get('data_size', 0)),
+                'compact_running': metadata.get('compact_running', False)}
+
+    def compact(self):
+        """
+        start compaction of database, files of no longer used indexes get cleaned up too
+        CouchDB does the work in background
+        """
+        for path in ['_compact', '_view_cleanup']:
+            response = self.database.r_session.post(f'{self.database.database_url}/{path}',
+                                                    headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+
+    def save_document(self, document):
+        """
+        write one document on its own
+        """
+        couch_document = Document(self.database)
+        couch_document.update(document)
+        couch_document.save()
+        document['_rev'] = couch_document['_rev']
+
+    def delete_document(self, document):
+        """
+        delete one document in its current revision
+        """
+        couch_document = Document(self.database)
+        couch_document.update(document)
+        couch_document.delete()
+
+
+class SQLiteBackend:
+    """
+    documents stored as JSON in one local SQLite table - for single-node installations and offline benchmarks
+    one process owns the file so revisions only emulate CouchDB and the last write wins
+    """
+    # nobody else writes into the file so there are no changes to follow
+    changes_feed = False
+
+    def __init__(self, app):
+        self.path = app.config['SQLITE_PATH']
+        # handlers and background tasks share the connection, the lock keeps their transactions apart
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.lock = Lock()
+        # write-ahead log makes commits cheap and lets readers go on while writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents '
+                                '(id TEXT PRIMARY KEY, rev TEXT NOT NULL, body TEXT NOT NULL)')
+
+    @property
+    def url(self):
+        return f'sqlite:///{self.path}'
+
+    def iterate_documents(self, prefix='', include_docs=True, page_size=1000):
+        """
+        walk through documents sorted by ID, optionally limited to IDs starting with prefix
+        yields document IDs and documents, the latter None without include_docs
+        """
+        with self.lock:
+            rows = self.connection.execute(f'SELECT id{", body" if include_docs else ""} FROM documents '
+                                           'WHERE id >= ? AND id < ? ORDER BY id',
+                                           (prefix, f'{prefix}\ufff0')).fetchall()
+        for row in rows:
+            yield row[0], loads(row[1]) if include_docs else None
+
+    def load_document(self, document_id):
+        """
+        retrieves one single document, None if it does not exist
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT body FROM documents WHERE id = ?', (document_id,)).fetchone()
+        if row:
+            return loads(row[0])
+        return None
+
+    def revisions(self, document_ids):
+        """
+        current revisions of existing documents
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT id, rev FROM documents '
+                                           f'WHERE id IN ({", ".join("?" * len(document_ids))})',
+                                           document_ids).fetchall()
+        return dict(rows)
+
+    def stats(self):
+        """
+        file size versus size of live data to know about fragmentation
+        """
+        with self.lock:
+            page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+            page_count = self.connection.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = self.connection.execute('PRAGMA freelist_count').fetchone()[0]
+        return {'file_size': page_size * page_count,
+                'data_size': page_size * (page_count - freelist_count),
+                'compact_running': False}
+
+    def compact(self):
+        """
+        move write-ahead log into database and rebuild it without free pages
+        """
+        with self.lock:
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.connection.execute('VACUUM')
+
+    def save_documents(self, documents):
+        """
+        write multiple documents in one single transaction
+        results look like the ones of CouchDB _bulk_docs
+        """
+        results = []
+        rows = []
+        deleted = []
+        for document in documents:
+            # revisions count up like CouchDB ones to be recognizable
+            generation = int(document.get('_rev', '0-').split('-')[0]) + 1
+            revision = f'{generation}-{uuid4().hex}'
+            if document.get('_deleted'):
+                deleted.append((document['_id'],))
+            else:
+                rows.append((document['_id'], revision, dumps(dict(document, _rev=revision))))
+            results.append({'ok': True, 'id': document['_id'], 'rev': revision})
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany('INSERT OR REPLACE INTO documents (id, rev, body) VALUES (?, ?, ?)',
+                                            rows)
+                self.connection.executemany('DELETE FROM documents WHERE id = ?', deleted)
+        return results
+
+    def save_document(self, document):
+        """
+        write one document on its own
+        """
+        document['_rev'] = self.save_documents([document])[0]['rev']
+
+    def delete_document(self, document):
+        """
+        delete one document
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.execute('DELETE FROM documents WHERE id = ?', (document['_id'],))
+
+
+# available storage backends, selected by DATABASE_BACKEND
+BACKENDS = {'couchdb': CouchDBBackend,
+            'sqlite': SQLiteBackend}
+
+
+class DB:
+    """
+    database connection and queries
+    """
+    def __init__(self, app):
+        self.backend = BACKENDS[app.config.get('DATABASE_BACKEND', 'couchdb')](app)
+
+        # tricks might be stored inside their round documents
+        self.embed_tricks = app.config.get('EMBED_TRICKS', False)
+        # other processes writing into the same database need some documents written at once, like ID counters
+        self.shared = bool(app.config.get('CHANGES_FEED')) and self.backend.changes_feed
+
+        # IDs of documents currently on their way to storage
+        self.saving = set()
+        # unreachable storage opens the breaker and game goes on from memory meanwhile
+        self.breaker = CircuitBreaker(threshold=app.config.get('STORAGE_FAILURE_THRESHOLD', 5),
+                                      reset_timeout=app.config.get('STORAGE_RESET_TIMEOUT', 30))
+        # failed writes are tried again that often, waiting twice as long as before every time
+        self.retries = app.config.get('STORAGE_RETRIES', 3)
+        self.retry_delay = app.config.get('STORAGE_RETRY_DELAY', 0.1)
+        # documents which could not be written because storage was unreachable
+        self.queued = {}
+        # gets stored versions of documents changed by another process meanwhile, set by game
+        self.conflict_handler = None
+
+        # with cooperative I/O another event might want to write while one is waiting for storage
+        # writes have to be in order to always send the latest revisions - reentrant for single fallback writes
+        self.write_lock = RLock()
+
+        # saves of documents which really changed versus saves which could be skipped
+        self.save_counts = {'written': 0,
+                            'skipped': 0}
+
+        # documents saved while handling one event are collected here - one collection per thread
+        # as long as documents is None there is no unit of work active and documents are saved at once
+        self.work = local()
+
+        # optional write-behind mode, documents get journaled and are written by a background task
+        if app.config.get('WRITE_BEHIND'):
+            self.write_behind = WriteBehind(self,
+                                            path=app.config['WRITE_BEHIND_JOURNAL'],
+                                            interval=app.config['WRITE_BEHIND_INTERVAL'])
+        else:
+            self.write_behind = None
+
+        # storage gets compacted when it got too fragmented
+        if app.config.get('COMPACTION_INTERVAL'):
+            self.maintenance = Maintenance(self,
+                                           interval=app.config['COMPACTION_INTERVAL'],
+                                           fragmentation=app.config['COMPACTION_FRAGMENTATION'],
+                                           writes=app.config['COMPACTION_WRITES'])
+        else:
+            self.maintenance = None
+
+    def load_documents(self, prefixes=None, include_docs=True):
+        """
+        retrieves all documents in one single pass, sorted by their ID prefix
+        players and tables are keyed by document ID, tricks and rounds by the ID without prefix
+        prefixes limit the pass to the given ID ranges, without include_docs only the IDs are of interest
+        """
+        result = {x: {} for x in DOCUMENT_TYPES}
+        with self.reading():
+            for prefix in prefixes or ['']:
+                for document_id, document in self.backend.iterate_documents(prefix=prefix,
+                                                                            include_docs=include_docs):
+                    document_type, _, item_id = document_id.partition('-')
+                    # design documents and whatever else does not belong to the game are ignored
+                    if document_type in result and item_id:
+                        if document_type in ['player', 'table']:
+                            item_id = document_id
+                        result[document_type][item_id] = document
         return result
 
+    def load_document(self, document_id):
+        """
+        retrieves one single document, None if it does not exist
+        """
+        with self.reading():
+            return self.backend.load_document(document_id)
+
+    @contextmanager
+    def reading(self):
+        """
+        reads go through the circuit breaker too and fail with StorageUnavailable if storage is unreachable
+        """
+        if not self.breaker.allow():
+            raise StorageUnavailable(self.backend.url)
+        try:
+            yield
+        except Exception as error:
+            if is_retryable(error):
+                print('ERROR', self.backend.url, 'read')
+                print(error)
+                self.breaker.failure(error)
+                raise StorageUnavailable(self.backend.url) from error
+            raise
+        self.breaker.success()
 
-class Document3000(Document):
+    def is_pending(self, document_id):
+        """
+        check if document still waits for being written in write-behind mode
+        """
+        return bool(self.write_behind) and document_id in self.write_behind.pending
+
+    def is_busy(self, document_id):
+        """
+        check if local state of document is newer than the stored one because it is still being written
+        """
+        return document_id in self.saving or self.is_pending(document_id)
+
+    def count_writes(self, count=1):
+        """
+        writes make storage grow, so maintenance has to know about them
+        """
+        if self.maintenance:
+            self.maintenance.writes_since_compaction += count
+
+    def changes(self, since):
+        """
+        get changes made by other processes, returns an empty list if storage cannot be reached
+        """
+        try:
+            return self.backend.changes(since)
+        except Exception as error:
+            print('ERROR', self.backend.url, '_changes')
+            print(error)
+            return [], since
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        collect every document saved while handling one event and write them all at once when done
+        works as decorator for socket.io events and routes too
+        """
+        if getattr(self.work, 'documents', None) is not None:
+            # nested unit of work - the outermost one does the writing
+            yield
+            return
+        self.work.documents = {}
+        try:
+            yield
+        finally:
+            documents = list(self.work.documents.values())
+            self.work.documents = None
+            self.persist(documents)
+
+    def is_collecting(self):
+        """
+        check if saved documents get collected by a unit of work or write-behind journal
+        """
+        return getattr(self.work, 'documents', None) is not None or bool(self.write_behind)
+
+    def collect(self, document):
+        """
+        put document into current unit of work or write-behind journal
+        returns False if there is none of both and document has to be saved directly
+        """
+        documents = getattr(self.work, 'documents', None)
+        if documents is not None:
+            # the same document saved several times needs only to be written once
+            documents[document['_id']] = document
+            return True
+        if self.write_behind:
+            # without unit of work the journal has to get the document as saved now, so it is checked now too
+            self.write_behind.add(self.changed([document]))
+            return True
+        return False
+
+    def discard(self, document):
+        """
+        forget collected document, e.g. because it is deleted meanwhile
+        """
+        documents = getattr(self.work, 'documents', None)
+        if documents:
+            documents.pop(document.get('_id'), None)
+        self.queued.pop(document.get('_id'), None)
+        if self.write_behind:
+            self.write_behind.discard(document)
+
+    def changed(self, documents):
+        """
+        only documents whose content differs from the last saved one need to be written
+        documents of a unit of work are checked when it ends because they might still change after being collected
+        """
+        result = []
+        for document in documents:
+            if document.is_changed():
+                self.save_counts['written'] += 1
+                result.append(document)
+            else:
+                self.save_counts['skipped'] += 1
+        return result
+
+    def persist(self, documents):
+        """
+        either journal documents for writing them later or write them at once
+        """
+        documents = self.changed(documents)
+        if self.write_behind:
+            self.write_behind.add(documents)
+        else:
+            self.queue(self.save_documents(documents))
+
+    def queue(self, documents):
+        """
+        keep documents for writing them when storage is reachable again
+        """
+        if documents and not self.queued:
+            print('ERROR', self.backend.url, 'could not write documents, they are queued until it works')
+        for document in documents:
+            self.queued[document['_id']] = document
+
+    def replay_queued(self):
+        """
+        write queued documents if storage might be reachable again
+        """
+        if self.queued and self.breaker.allow():
+            count = len(self.queued)
+            if not self.save_documents(list(self.queued.values())):
+                print('INFO', f'wrote {count} queued documents')
+
+    def save_documents(self, documents, conflicts=None):
+        """
+        write multiple documents at once
+        returns documents which could not be written and have to be kept for later
+        conflicting documents are merged with their stored versions or put into conflicts if given
+        """
+        if not documents:
+            return []
+        if not self.breaker.allow():
+            return documents
+        document_ids = {x['_id'] for x in documents}
+        # documents stay busy while waiting for a retry, so changes of other processes do not overwrite them
+        self.saving.update(document_ids)
+        try:
+            failed, conflicting = self.write_documents(documents)
+        finally:
+            self.saving.difference_update(document_ids)
+        # documents are not stored so they must not be skipped next time
+        for document in failed:
+            if isinstance(document, Document3000):
+                document.fingerprint = None
+        if conflicts is not None:
+            conflicts.extend(conflicting)
+        elif conflicting:
+            failed += self.resolve_conflicts(conflicting)
+        return failed
+
+    def write_documents(self, documents):
+        """
+        write documents and try again after temporary errors, waiting longer every time
+        returns documents which could not be written and those another process changed meanwhile
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # lock is not held while waiting, so a hanging storage does not stop every other write
+                sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                # writes have to be in order to always send the latest revisions
+                with self.write_lock:
+                    results = self.backend.save_documents(documents)
+            except Exception as exception:
+                print('ERROR', self.backend.url, 'save_documents', f'attempt {attempt + 1}')
+                print(exception)
+                if not is_retryable(exception):
+                    # refused documents stay queued instead of getting lost
+                    return documents, []
+                error = exception
+                continue
+            self.breaker.success()
+            self.count_writes(len(documents))
+            failed = []
+            conflicts = []
+            # results come in the same order as the documents were sent
+            for document, result in zip(documents, results):
+                if result.get('rev') and not result.get('error'):
+                    document['_rev'] = result['rev']
+                    self.queued.pop(document['_id'], None)
+                elif result.get('error') == 'conflict':
+                    conflicts.append(document)
+                else:
+                    print('ERROR', self.backend.url, document['_id'], result.get('error'), result.get('reason'))
+                    failed.append(document)
+            return failed, conflicts
+        self.breaker.failure(error)
+        return documents, []
+
+    def resolve_conflicts(self, documents):
+        """
+        another process sharing the database changed documents meanwhile and its changes must not be overwritten
+        stored documents get loaded and applied like changes from the changes feed
+        returns documents which could not be loaded and have to be tried again later
+        """
+        print('ERROR', self.backend.url, 'conflict, loading stored documents', [x['_id'] for x in documents])
+        changes = []
+        for document in documents:
+            try:
+                stored = self.load_document(document['_id'])
+            except StorageUnavailable:
+                return documents
+            self.queued.pop(document['_id'], None)
+            if stored is None:
+                # deleted by the other process - a revision newer than the known one lets it vanish here too
+                generation = int(document.get('_rev', '0-').split('-')[0]) + 1
+                changes.append({'id': document['_id'],
+                                'changes': [{'rev': f'{generation}-deleted'}],
+                                'deleted': True})
+            else:
+                changes.append({'id': document['_id'],
+                                'changes': [{'rev': stored['_rev']}],
+                                'doc': stored})
+        if self.conflict_handler:
+            self.conflict_handler(changes)
+        return []
+
+    def health(self):
+        """
+        state of storage connection, game keeps running from memory if storage is unreachable
+        """
+        if self.breaker.state == 'closed' and not self.queued:
+            status = 'ok'
+        else:
+            status = 'degraded'
+        return {'status': status,
+                'storage': self.breaker.status(),
+                'queued': len(self.queued),
+                'write_behind_lag': round(self.write_behind.lag, 3) if self.write_behind else None}
+
+    def run(self, sleep):
+        """
+        background task writing queued documents when storage is back
+        sleep is given by socket.io to fit its async mode
+        """
+        while True:
+            sleep(1)
+            self.replay_queued()
+
+
+class WriteBehind:
     """
-    extend Document class with a conflict-aware save()
+    journal saved documents locally and write them to CouchDB in background
     """
-    def __init__(self, database=None, document_id=None):
-        super().__init__(database=database, document_id=document_id)
+    def __init__(self, db, path, interval, batch_size=100):
+        self.db = db
+        self.path = Path(path)
+        self.interval = interval
+        self.batch_size = batch_size
+        # documents waiting to be written, newest state of a document wins
+        self.pending = {}
+        # moment the oldest pending document got journaled
+        self.pending_since = None
+        # journal and pending documents are accessed by event handlers and background task
+        self.lock = Lock()
+        self.journal = self.path.open('a')
 
-    def save(self):
+    @property
+    def lag(self):
+        """
+        seconds the oldest not yet written change is waiting for CouchDB
+        """
+        if self.pending_since is None:
+            return 0.0
+        return time() - self.pending_since
+
+    def append(self, entries):
+        """
+        add entries to journal and make sure they really are on disk
+        """
+        self.journal.write(''.join(f'{dumps(x)}\n' for x in entries))
+        self.journal.flush()
+        fsync(self.journal.fileno())
+
+    def add(self, documents):
+        """
+        journal documents and queue them for the next background write
+        """
+        if not documents:
+            return
+        with self.lock:
+            self.append(documents)
+            for document in documents:
+                self.pending[document['_id']] = document
+            if self.pending_since is None:
+                self.pending_since = time()
+
+    def discard(self, document):
+        """
+        deleted documents are not to be written anymore - and must not be revived by a journal replay
+        """
+        with self.lock:
+            self.pending.pop(document.get('_id'), None)
+            self.append([{'_id': document.get('_id'), '_deleted': True}])
+
+    def flush(self):
+        """
+        write pending documents to CouchDB in batches
+        """
+        while self.pending:
+            with self.lock:
+                documents = list(self.pending.values())[:self.batch_size]
+                for document in documents:
+                    self.pending.pop(document['_id'])
+            failed = self.db.save_documents(documents)
+            if failed:
+                # CouchDB not reachable - keep documents unless they got changed again meanwhile
+                with self.lock:
+                    for document in failed:
+                        self.pending.setdefault(document['_id'], document)
+                return False
+        with self.lock:
+            if not self.pending:
+                self.pending_since = None
+            self.rewrite()
+        return True
+
+    def rewrite(self):
+        """
+        journal only needs to hold what is still pending - replaced atomically to survive a crash meanwhile
         """
-        save() inside try/except for debugging
+        self.journal.close()
+        path_new = self.path.with_name(f'{self.path.name}.new')
+        with path_new.open('w') as journal_new:
+            journal_new.write(''.join(f'{dumps(x)}\n' for x in self.pending.values()))
+            journal_new.flush()
+            fsync(journal_new.fileno())
+        replace(path_new, self.path)
+        self.journal = self.path.open('a')
+
+    def replay(self):
+        """
+        write documents left in journal by a crash to CouchDB before game gets loaded
+        """
+        documents = {}
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                try:
+                    document = loads(line)
+                except ValueError:
+                    # last line might be incomplete after a crash
+                    continue
+                documents[document['_id']] = document
+        documents = [x for x in documents.values() if not x.get('_deleted')]
+        if documents:
+            # journal is newer than CouchDB so its documents win, no matter which revision they are based on
+            revisions = self.db.backend.revisions([x['_id'] for x in documents])
+            for document in documents:
+                if document['_id'] in revisions:
+                    document['_rev'] = revisions[document['_id']]
+                else:
+                    document.pop('_rev', None)
+            results = self.db.backend.save_documents(documents)
+            for result in results:
+                if result.get('error'):
+                    print('ERROR', 'journal replay', result.get('id'), result.get('error'), result.get('reason'))
+            print('INFO', f'replayed {len(documents)} documents from journal {self.path}')
+        with self.lock:
+            self.rewrite()
+
+    def run(self, sleep):
+        """
+        background task writing pending documents periodically
+        sleep is given by socket.io to fit its async mode
+        """
+        while True:
+            sleep(self.interval)
+            if self.pending:
+                self.flush()
+
+
+class Maintenance:
+    """
+    watch growth of storage and compact it when it got too fragmented or too many writes happened
+    """
+    def __init__(self, db, interval, fragmentation, writes, min_file_size=2 ** 20, history_size=20):
+        self.db = db
+        self.interval = interval
+        # share of file size not used by live data which triggers compaction
+        self.fragmentation = fragmentation
+        # number of written documents which triggers compaction, 0 ignores writes
+        self.writes = writes
+        # small files are not worth the effort
+        self.min_file_size = min_file_size
+        self.writes_since_compaction = 0
+        # latest compactions for admin overview
+        self.history = deque(maxlen=history_size)
+
+    @staticmethod
+    def get_fragmentation(stats):
+        """
+        share of file not used by live data
+        """
+        if not stats['file_size']:
+            return 0.0
+        return 1 - stats['data_size'] / stats['file_size']
+
+    def status(self):
+        """
+        current state and history of compactions
+        """
+        stats = self.db.backend.stats()
+        return {'file_size': stats['file_size'],
+                'data_size': stats['data_size'],
+                'fragmentation': round(self.get_fragmentation(stats), 3),
+                'compact_running': stats['compact_running'],
+                'writes_since_compaction': self.writes_since_compaction,
+                'thresholds': {'fragmentation': self.fragmentation,
+                               'writes': self.writes,
+                               'min_file_size': self.min_file_size},
+                'history': list(self.history)}
+
+    def check(self):
+        """
+        compact if thresholds are crossed
         """
         try:
-            super().save()
+            stats = self.db.backend.stats()
         except Exception as error:
-            print('ERROR', self.document_url)
+            print('ERROR', self.db.backend.url, 'stats')
             print(error)
+            return
+        if stats['compact_running'] or stats['file_size'] < self.min_file_size:
+            return
+        fragmentation = self.get_fragmentation(stats)
+        if fragmentation >= self.fragmentation:
+            self.compact(stats, f'fragmentation {fragmentation:.2f}')
+        elif self.writes and self.writes_since_compaction >= self.writes:
+            self.compact(stats, f'{self.writes_since_compaction} writes')
+
+    def compact(self, stats, reason):
+        """
+        compact storage and remember when and why
+        """
+        time_start = time()
+        try:
+            self.db.backend.compact()
+        except Exception as error:
+            print('ERROR', self.db.backend.url, 'compact')
+            print(error)
+            return
+        self.history.append({'time': int(time_start),
+                             'reason': reason,
+                             'file_size': stats['file_size'],
+                             'data_size': stats['data_size'],
+                             'duration': round(time() - time_start, 3)})
+        self.writes_since_compaction = 0
+        print('INFO', f'compaction of {self.db.backend.url} started because of {reason}')
+
+    def run(self, sleep):
+        """
+        background task checking storage periodically
+        sleep is given by socket.io to fit its async mode
+        """
+        while True:
+            sleep(self.interval)
+            self.check()
+
+
+class Document3000(dict):
+    """
+    game document with a conflict-aware save(), stored by whatever backend DB uses
+    """
+    def __init__(self, db=None, document_id=None):
+        # DB is needed to know about an active unit of work
+        self.db = db
+        # fingerprint of content when it was saved last time - None if unknown
+        self.fingerprint = None
+        # subclasses might have set items before - keep them
+        super().__init__()
+        if document_id:
+            self['_id'] = document_id
+
+    def get_fingerprint(self):
+        """
+        hash of content without revision which changes on every write anyway
+        """
+        return md5(dumps({x: y for x, y in self.items() if x != '_rev'}, sort_keys=True).encode()).digest()
+
+    def mark_saved(self):
+        """
+        remember content as saved, e.g. after loading it from storage
+        """
+        self.fingerprint = self.get_fingerprint()
+
+    def is_changed(self):
+        """
+        check if content differs from the last saved one and remember it as saved if so
+        """
+        fingerprint = self.get_fingerprint()
+        if fingerprint == self.fingerprint:
+            return False
+        self.fingerprint = fingerprint
+        return True
+
+    def __getstate__(self):
+        """
+        references to DB and game are not part of a snapshot and get restored after loading it
+        """
+        return {x: y for x, y in self.__dict__.items() if x not in ['db', 'game']}
+
+    def save(self):
+        """
+        only collect document if a unit of work is active, otherwise write it at once
+        unchanged documents do not need to be saved at all
+        """
+        if not self.db.collect(self) and \
+                self.db.changed([self]):
+            self.write()
+
+    def write(self):
+        """
+        write document at once or queue it if storage is not reachable
+        """
+        self.db.queue(self.db.save_documents([self]))
+
+    def delete(self):
+        """
+        a deleted document must not be written by a pending unit of work anymore
+        inside a unit of work the deletion is written together with the other documents
+        """
+        self.db.discard(self)
+        # a document without revision never made it into storage, e.g. in write-behind mode
+        if self.get('_rev'):
+            if getattr(self.db.work, 'documents', None) is not None:
+                tombstone = Document3000(self.db, self['_id'])
+                tombstone.update({'_rev': self['_rev'],
+                                  '_deleted': True})
+                self.db.collect(tombstone)
+                return
+            try:
+                with self.db.write_lock:
+                    self.db.backend.delete_document(self)
+            except Exception as error:
+                print('ERROR', self.db.backend.url, 'delete', self.get('_id'))
+                print(error)
@@ -0,0 +1,252 @@
+# fake CouchDB for running doko3000 offline, e.g. for tests and benchmarks
+#
+# implements only the subset of the CouchDB API doko3000 uses, everything lives in memory
+# run it with 'python -m doko3000.fake_couchdb --port 5984 --latency 0.005' and point COUCHDB_URL to it
+
+from argparse import ArgumentParser
+from json import dumps, \
+    loads
+from random import random
+from threading import Lock, \
+    Thread
+from time import sleep
+from urllib.parse import unquote
+from uuid import uuid4
+
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, \
+    Response
+
+
+class FakeCouchDB:
+    """
+    WSGI application answering like CouchDB
+    latency and errors can be injected to see how doko3000 copes with a slow or broken database
+    """
+    def __init__(self, latency=0.0, error_rate=0.0):
+        # seconds every request takes
+        self.latency = latency
+        # share of requests answered with 503
+        self.error_rate = error_rate
+        # answer every request with 503, like a CouchDB being down
+        self.down = False
+        # databases with their documents, sequences and changes
+        self.databases = {}
+        # number of requests per method and path for benchmarks
+        self.counts = {}
+        self.lock = Lock()
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if self.latency:
+            sleep(self.latency)
+        if self.down or \
+                (self.error_rate and random() < self.error_rate):
+            response = self.answer({'error': 'unavailable', 'reason': 'injected error'}, 503)
+        else:
+            with self.lock:
+                response = self.handle(request)
+        return response(environ, start_response)
+
+    @staticmethod
+    def answer(data, status=200):
+        return Response(dumps(data), status=status, content_type='application/json')
+
+    def count(self, request, path):
+        """
+        count requests by method and path without document IDs
+        """
+        key = ' '.join([request.method, '/'.join(path[:1] + [x for x in path[1:] if x.startswith('_')])])
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def create_database(self, name):
+        self.databases[name] = {'documents': {},
+                                # revisions of deleted documents are still needed for _changes
+                                'deleted': {},
+                                'update_seq': 0,
+                                'changes': {},
+                                'revs_limit': 1000}
+
+    def store(self, database, document):
+        """
+        store document if its revision is the current one, like CouchDB does
+        """
+        old_document = database['documents'].get(document['_id'])
+        old_revision = old_document['_rev'] if old_document else database['deleted'].get(document['_id'])
+        if document.get('_rev') != (old_document or {}).get('_rev'):
+            return {'id': document['_id'], 'error': 'conflict', 'reason': 'Document update conflict.'}, 409
+        generation = int(old_revision.split('-')[0]) + 1 if old_revision else 1
+        revision = f'{generation}-{uuid4().hex}'
+        if document.get('_deleted'):
+            database['documents'].pop(document['_id'], None)
+            database['deleted'][document['_id']] = revision
+        else:
+            database['documents'][document['_id']] = dict(document, _rev=revision)
+            database['deleted'].pop(document['_id'], None)
+        database['update_seq'] += 1
+        # only the latest change of a document is of interest
+        database['changes'].pop(document['_id'], None)
+        database['changes'][document['_id']] = database['update_seq']
+        return {'ok': True, 'id': document['_id'], 'rev': revision}, 201
+
+    def handle(self, request):
+        path = [unquote(x) for x in request.environ.get('RAW_URI', request.path).split('?')[0].split('/') if x]
+        self.count(request, path)
+        if not path:
+            return self.answer({'couchdb': 'Welcome', 'version': '3.3.3', 'vendor': {'name': 'doko3000 fake'}})
+        if path[0] == '_session':
+            response = self.answer({'ok': True, 'name': 'admin', 'roles': ['_admin']})
+            response.set_cookie('AuthSession', uuid4().hex)
+            return response
+        if path[0] == '_all_dbs':
+            return self.answer(sorted(self.databases))
+        if len(path) == 1:
+            return self.handle_database(request, path[0])
+        database = self.databases.get(path[0])
+        if database is None:
+            return self.answer({'error': 'not_found', 'reason': 'Database does not exist.'}, 404)
+        if path[1] == '_bulk_docs':
+            return self.bulk_docs(request, database)
+        if path[1] == '_all_docs':
+            return self.all_docs(request, database)
+        if path[1] == '_changes':
+            return self.changes(request, database)
+        if path[1] in ['_compact', '_view_cleanup']:
+            return self.answer({'ok': True}, 202)
+        if path[1] == '_revs_limit':
+            if request.method == 'PUT':
+                database['revs_limit'] = int(request.get_data())
+                return self.answer({'ok': True})
+            return self.answer(database['revs_limit'])
+        if path[1] == '_design':
+            return self.handle_document(request, database, '/'.join(path[1:3]))
+        return self.handle_document(request, database, '/'.join(path[1:]))
+
+    def handle_database(self, request, name):
+        if request.method == 'PUT':
+            if name in self.databases:
+                return self.answer({'error': 'file_exists'}, 412)
+            self.create_database(name)
+            return self.answer({'ok': True}, 201)
+        if name not in self.databases:
+            return self.answer({'error': 'not_found', 'reason': 'Database does not exist.'}, 404)
+        if request.method == 'DELETE':
+            self.databases.pop(name)
+            return self.answer({'ok': True})
+        if request.method == 'POST':
+            document = request.get_json(force=True)
+            document.setdefault('_id', uuid4().hex)
+            return self.answer(*self.store(self.databases[name], document))
+        database = self.databases[name]
+        size = len(dumps(database['documents']))
+        return self.answer({'db_name': name,
+                            'doc_count': len(database['documents']),
+                            'update_seq': f'{database["update_seq"]}-fake',
+                            'compact_running': False,
+                            'sizes': {'file': size, 'active': size, 'external': size}})
+
+    def handle_document(self, request, database, document_id):
+        document = database['documents'].get(document_id)
+        if request.method in ['GET', 'HEAD']:
+            if document is None:
+                return self.answer({'error': 'not_found', 'reason': 'missing'}, 404)
+            return self.answer(document)
+        if request.method == 'PUT':
+            document = request.get_json(force=True)
+            document['_id'] = document_id
+            if request.args.get('rev'):
+                document['_rev'] = request.args['rev']
+            return self.answer(*self.store(database, document))
+        if request.method == 'DELETE':
+            return self.answer(*self.store(database, {'_id': document_id,
+                                                      '_rev': request.args.get('rev'),
+                                                      '_deleted': True}))
+        return self.answer({'error': 'method_not_allowed'}, 405)
+
+    def bulk_docs(self, request, database):
+        results = []
+        for document in request.get_json(force=True)['docs']:
+            document.setdefault('_id', uuid4().hex)
+            results.append(self.store(database, document)[0])
+        return self.answer(results, 201)
+
+    def all_docs(self, request, database):
+        document_ids = sorted(database['documents'])
+        if request.method == 'POST' or 'keys' in request.args:
+            if 'keys' in request.args:
+                keys = loads(request.args['keys'])
+            else:
+                keys = request.get_json(force=True)['keys']
+            rows = []
+            for key in keys:
+                if key in database['documents']:
+                    rows.append({'id': key, 'key': key, 'value': {'rev': database['documents'][key]['_rev']}})
+                elif key in database['deleted']:
+                    rows.append({'id': key, 'key': key, 'value': {'rev': database['deleted'][key], 'deleted': True}})
+                else:
+                    rows.append({'key': key, 'error': 'not_found'})
+            return self.answer({'rows': rows})
+        start_key = request.args.get('startkey') or request.args.get('start_key')
+        if start_key:
+            document_ids = [x for x in document_ids if x >= loads(start_key)]
+        end_key = request.args.get('endkey') or request.args.get('end_key')
+        if end_key:
+            document_ids = [x for x in document_ids if x <= loads(end_key)]
+        offset = int(request.args.get('skip', 0))
+        document_ids = document_ids[offset:]
+        if 'limit' in request.args:
+            document_ids = document_ids[:int(request.args['limit'])]
+        rows = []
+        for document_id in document_ids:
+            row = {'id': document_id, 'key': document_id, 'value': {'rev': database['documents'][document_id]['_rev']}}
+            if request.args.get('include_docs') == 'true':
+                row['doc'] = database['documents'][document_id]
+            rows.append(row)
+        return self.answer({'total_rows': len(database['documents']), 'offset': offset, 'rows': rows})
+
+    def changes(self, request, database):
+        since = request.args.get('since', '0')
+        if since == 'now':
+            since = database['update_seq']
+        else:
+            since = int(str(since).split('-')[0])
+        results = []
+        for document_id, sequence in database['changes'].items():
+            if sequence > since:
+                if document_id in database['documents']:
+                    document = database['documents'][document_id]
+                    result = {'seq': f'{sequence}-fake', 'id': document_id, 'changes': [{'rev': document['_rev']}]}
+                else:
+                    revision = database['deleted'][document_id]
+                    document = {'_id': document_id, '_rev': revision, '_deleted': True}
+                    result = {'seq': f'{sequence}-fake', 'id': document_id, 'changes': [{'rev': revision}],
+                              'deleted': True}
+                if request.args.get('include_docs') == 'true':
+                    result['doc'] = document
+                results.append(result)
+        return self.answer({'results': results, 'last_seq': f'{database["update_seq"]}-fake'})
+
+
+def serve(host='127.0.0.1', port=5984, latency=0.0, error_rate=0.0):
+    """
+    start fake CouchDB in a background thread, e.g. from a test or benchmark
+    returns the fake to inject latency and errors and the server to shut it down
+    """
+    fake = FakeCouchDB(latency=latency, error_rate=error_rate)
+    server = make_server(host, port, fake, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return fake, server
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='fake CouchDB for running doko3000 offline')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5984)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    arguments = parser.parse_args()
+    print('INFO', f'fake CouchDB listening at http://{arguments.host}:{arguments.port}')
+    make_server(arguments.host,
+                arguments.port,
+                FakeCouchDB(latency=arguments.latency, error_rate=arguments.error_rate),
+                threaded=True).serve_forever()
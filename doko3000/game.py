@@ -1,25 +1,41 @@
 # game logic part of doko3000
-from copy import deepcopy
 from json import dumps
-from os import environ
+from os import fsync, \
+    replace
 from pathlib import Path
+from pickle import dumps as pickle_dumps, \
+    HIGHEST_PROTOCOL, \
+    loads as pickle_loads
 from random import seed, \
     shuffle
 from time import time
+from zlib import compress, \
+    decompress
 
 # from cloudant.document import Document
 from flask_login import UserMixin
 from werkzeug.security import check_password_hash, \
     generate_password_hash
 
-from .database import Document3000
+from .config import is_true
+from .database import Document3000, \
+    DOCUMENT_TYPES, \
+    StorageUnavailable
 from .misc import get_hash
 
+# increased whenever the structure of game objects changes so older snapshots are not used anymore
+SNAPSHOT_FORMAT = 3
+
+# compare incrementally maintained round counters with a full recalculation after every change
+CHECK_COUNTERS = is_true('DOKO3000_DEVEL_CHECK_COUNTERS')
+
 
 class Card:
     """
     one single card
     """
+    # all cards are created once with the deck, so no per-instance dict is needed
+    __slots__ = ('symbol', 'rank', 'value', 'name', 'id')
 
     def __init__(self, symbol, rank_item, card_id):
         """
@@ -38,8 +54,7 @@ class Deck:
     """
     full deck of cards - enough to be static
     """
-    if environ.get('DOKO3000_DEVEL_REDUCED_CARD_SET') and \
-            environ.get('DOKO3000_DEVEL_REDUCED_CARD_SET').lower() in ['1', 'true', 'yes']:
+    if is_true('DOKO3000_DEVEL_REDUCED_CARD_SET'):
         SYMBOLS = ('Schell',
                    'Eichel')
         RANKS = {'Zehn': 10,
@@ -68,6 +83,16 @@ class Deck:
                 cards[card_id] = Card(symbol, rank, card_id)
                 card_id += 1
 
+    # card IDs of both deck variants - with or without '9'-cards
+    variants = {True: tuple(cards),
+                False: tuple(x.id for x in cards.values() if x.rank != 'Neun')}
+    # values of cards indexed by their ID for counting score
+    values = tuple(x.value for x in cards.values())
+    # bit of every card in integer masks of hands - unknown IDs are no key here
+    bits = {x: 1 << x for x in cards}
+    # mask of both Eichel Ober cards to count them in a hand at once
+    eichel_ober = sum(1 << x.id for x in cards.values() if x.name == 'Eichel-Ober')
+
     # expect SVG cards being default
     file_extension = 'svg'
 
@@ -94,6 +119,46 @@ class Deck:
             cards.append(self.cards[card_id])
         return cards
 
+    @classmethod
+    def get_variant(cls, with_9):
+        """
+        return new list of card IDs of deck with or without '9'-cards
+        """
+        return list(cls.variants[bool(with_9)])
+
+    @classmethod
+    def get_mask(cls, cards_ids):
+        """
+        integer mask with one bit per card - raises KeyError or TypeError if there are no valid card IDs
+        """
+        mask = 0
+        for card_id in cards_ids:
+            mask |= cls.bits[card_id]
+        return mask
+
+    @classmethod
+    def is_same_cards(cls, cards_ids, other_cards_ids, other_mask=None):
+        """
+        check if both lists contain the same cards, regardless of order
+        card IDs are unique so same masks and lengths mean same cards - an already known mask saves building it
+        """
+        try:
+            if len(cards_ids) != len(other_cards_ids):
+                return False
+            if other_mask is None:
+                other_mask = cls.get_mask(other_cards_ids)
+            return cls.get_mask(cards_ids) == other_mask
+        except (KeyError, TypeError):
+            # whatever a client sent, it is no list of card IDs
+            return False
+
+    @classmethod
+    def count_eichel_ober(cls, cards_mask):
+        """
+        count Eichel Ober cards in mask of cards
+        """
+        return (cards_mask & cls.eichel_ober).bit_count()
+
 
 class Player(UserMixin, Document3000):
     """
@@ -105,9 +170,11 @@ class Player(UserMixin, Document3000):
     def __init__(self, name='', document=None, game=None):
         # access to global game
         self.game = game
+        # mask of cards in hand, built when needed and kept until cards change
+        self.cards_mask = None
         if name:
             self['_id'] = self.game.create_player_id()
-            super().__init__(database=self.game.db.database)
+            super().__init__(db=self.game.db)
             # type is for CouchDB
             self['type'] = 'player'
             # name of player - to become somewhat more natural
@@ -128,9 +195,24 @@ class Player(UserMixin, Document3000):
             self['exchange_peer_id'] = ''
             self.save()
         elif document:
-            super().__init__(database=self.game.db.database, document_id=document['_id'])
+            super().__init__(db=self.game.db, document_id=document['_id'])
             # get data from given document
             self.update(document)
+            # loaded content does not need to be saved again
+            self.mark_saved()
+
+    def __setitem__(self, key, value):
+        if key == 'cards':
+            self.cards_mask = None
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        self.cards_mask = None
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self.cards_mask = None
+        super().clear()
 
     @property
     def id(self):
@@ -141,6 +223,14 @@ class Player(UserMixin, Document3000):
     def name(self):
         return self.get('name', '')
 
+    @name.setter
+    def name(self, value):
+        old_name = self.name
+        self['name'] = value
+        self.game.update_name_index(self, old_name)
+        self.game.player_changed(self.id)
+        self.save()
+
     @property
     def password_hash(self):
         return self.get('password_hash', '')
@@ -179,6 +269,7 @@ class Player(UserMixin, Document3000):
     @allows_spectators.setter
     def allows_spectators(self, value):
         self['allows_spectators'] = value
+        self.game.player_changed(self.id)
         self.save()
 
     @property
@@ -189,6 +280,7 @@ class Player(UserMixin, Document3000):
     @is_spectator_only.setter
     def is_spectator_only(self, value):
         self['is_spectator_only'] = value
+        self.game.player_changed(self.id)
         self.save()
 
     @property
@@ -197,8 +289,9 @@ class Player(UserMixin, Document3000):
 
     @table.setter
     def table(self, value):
-        self['table'] = value
-        self.save()
+        if self.get('table') != value:
+            self['table'] = value
+            self.save()
 
     @property
     def eichel_ober_count(self):
@@ -221,11 +314,11 @@ class Player(UserMixin, Document3000):
         """
         double-check if player sits at some table - make sure it can be deleted
         """
-        for table in self.game.tables.values():
-            if self.id in table.players:
-                # just in case the table was not stored yet
-                self.table = table.id
-                return True
+        table_id = self.game.player_tables.get(self.id)
+        if table_id is not None:
+            # just in case the table was not stored yet - setter only saves if it differs
+            self.table = table_id
+            return True
         return False
 
     @property
@@ -277,11 +370,27 @@ class Player(UserMixin, Document3000):
                 self.cards = cards
         return cards
 
+    def get_cards_mask(self):
+        """
+        mask of cards in hand, only built once per hand
+        """
+        if self.cards_mask is None:
+            self.cards_mask = Deck.get_mask(self.cards)
+        return self.cards_mask
+
+    def has_cards(self, cards_ids):
+        """
+        check if card IDs sent by client are exactly the ones in hand, regardless of order
+        """
+        return Deck.is_same_cards(cards_ids, self.cards, self.get_cards_mask())
+
     def remove_card(self, card_id):
         """
         remove card after having played it
         """
         self.cards.pop(self.cards.index(card_id))
+        if self.cards_mask is not None:
+            self.cards_mask &= ~Deck.bits[card_id]
         self.save()
 
     def remove_cards(self, card_ids):
@@ -291,6 +400,7 @@ class Player(UserMixin, Document3000):
         for card_id in card_ids:
             if card_id in self.cards:
                 self.cards.pop(self.cards.index(card_id))
+        self.cards_mask = None
         self.save()
 
     def remove_all_cards(self):
@@ -298,6 +408,7 @@ class Player(UserMixin, Document3000):
         if player is idle or gets new cards it doesn't need its old cards
         """
         self.cards.clear()
+        self.cards_mask = 0
         self.save()
 
     def exchange_new(self, peer_id):
@@ -316,25 +427,101 @@ class Player(UserMixin, Document3000):
 
 
 
+class Rules:
+    """
+    rules of a normal Doppelkopf game - which card may be played and who wins the trick
+    everything needed is looked up in tables indexed by card ID, built once for the deck
+    the order of cards does not depend on playing with or without '9'-cards, so one set of tables fits both
+    """
+    # trumps from highest to lowest - Herz-Zehn is no Herz card but the highest trump
+    TRUMPS = ('Herz-Zehn',
+              'Eichel-Ober',
+              'Grün-Ober',
+              'Herz-Ober',
+              'Schell-Ober',
+              'Eichel-Unter',
+              'Grün-Unter',
+              'Herz-Unter',
+              'Schell-Unter',
+              'Schell-Ass',
+              'Schell-Zehn',
+              'Schell-König',
+              'Schell-Neun')
+    # other cards from lowest to highest
+    RANKS = ('Neun',
+             'König',
+             'Zehn',
+             'Ass')
+
+    # suit of every card - either 'trump' or its symbol
+    suits = []
+    # strength of every card, only comparable within the same suit
+    strengths = []
+    # masks of all cards per suit to check with the mask of a hand if it contains any of them
+    suit_masks = {}
+    for card in Deck.cards.values():
+        if card.name in TRUMPS:
+            suits.append('trump')
+            strengths.append(len(TRUMPS) - TRUMPS.index(card.name))
+        else:
+            suits.append(card.symbol)
+            strengths.append(RANKS.index(card.rank))
+        suit_masks[suits[card.id]] = suit_masks.get(suits[card.id], 0) | Deck.bits[card.id]
+    suits = tuple(suits)
+    strengths = tuple(strengths)
+
+    @classmethod
+    def is_legal(cls, card_id, cards_hand_mask, cards_trick_ids):
+        """
+        check if card from hand may be played - suit of the first card in trick has to be followed if possible
+        """
+        if not cards_trick_ids:
+            return True
+        suit = cls.suits[cards_trick_ids[0]]
+        if cls.suits[card_id] == suit:
+            return True
+        # another suit is only allowed if hand has no card of the demanded one
+        return not cls.suit_masks[suit] & cards_hand_mask
+
+    @classmethod
+    def get_winner(cls, trick):
+        """
+        find out player who wins trick - of 2 equal cards the first one played wins
+        """
+        winner = 0
+        for index, card_id in enumerate(trick.cards):
+            best_id = trick.cards[winner]
+            if cls.suits[card_id] == cls.suits[best_id]:
+                if cls.strengths[card_id] > cls.strengths[best_id]:
+                    winner = index
+            elif cls.suits[card_id] == 'trump':
+                winner = index
+        return trick.players[winner]
+
+
 class Trick(Document3000):
     """
     contains all players and cards of moves - always 4
     2 synchronized lists, players and cards, should be enough to be indexed
     """
 
-    def __init__(self, trick_id='', document=None, game=None):
+    def __init__(self, trick_id='', document=None, game=None, round=None):
         self.game = game
+        # embedded tricks have no own document but live inside the one of their round
+        self.round = round
         if trick_id:
             # ID generated from Round object
             self['_id'] = f'trick-{trick_id}'
-            super().__init__(database=self.game.db.database)
+            super().__init__(db=self.game.db)
             self['type'] = 'trick'
             # initialize
             self.reset()
         elif document:
-            super().__init__(database=self.game.db.database, document_id=document['_id'])
+            super().__init__(db=self.game.db, document_id=document.get('_id'))
             # get document data from document
             self.update(document)
+            # loaded content does not need to be saved again
+            self.mark_saved()
 
     def __len__(self):
         return len(self['players'])
@@ -370,6 +557,15 @@ class Trick(Document3000):
         self['owner'] = False
         self.save()
 
+    def save(self):
+        """
+        embedded trick is saved together with its round
+        """
+        if self.round is not None:
+            self.round.save()
+        else:
+            super().save()
+
     def add_turn(self, player_id, card_id):
         """
         when player plays card it will be added
@@ -410,10 +606,13 @@ class Round(Document3000):
         self.game = game
         # collection of tricks per round - its number should not exceed cards_per_player
         self.tricks = {}
+        # counters kept up to date by every change of tricks instead of looking into all tricks at every access
+        self.counters = {'trick_count': 0,
+                         'played_cards': []}
         if round_id:
             # ID for CouchDB - comes already quoted from table
             self['_id'] = f'round-{round_id}'
-            super().__init__(database=self.game.db.database)
+            super().__init__(db=self.game.db)
             # type is for CouchDB
             self['type'] = 'round'
             # what table?
@@ -432,6 +631,8 @@ class Round(Document3000):
             # even if not logical too just keep the undo setting here too to keep the table/round-settings together
             self['allow_undo'] = True
             self['allow_exchange'] = True
+            # house rules are default so the server does not check cards and claiming tricks is up to players
+            self['use_rules'] = False
             # timestamp as checksum to avoid mess on client side if new cards are dealed
             # every deal gets its own timestamp to make cards belonging together
             self['cards_timestamp'] = 0
@@ -445,15 +646,14 @@ class Round(Document3000):
             # initialize
             self.reset(players=players)
         elif document:
-            super().__init__(database=self.game.db.database, document_id=document['_id'])
+            super().__init__(db=self.game.db, document_id=document['_id'])
             # get data from given document
             self.update(document)
+            # loaded content does not need to be saved again
+            self.mark_saved()
             # a new card deck for every round
             # decide if the '9'-cards are needed and do not give them to round if not
-            if self.with_9:
-                self.cards = list(Deck.cards)
-            else:
-                self.cards = [x.id for x in Deck.cards.values() if x.rank != 'Neun']
+            self.cards = Deck.get_variant(self.with_9)
             # cards per player depend on playing with '9'-cards or not
             self.cards_per_player = len(self.cards) // 4
 
@@ -469,22 +669,72 @@ class Round(Document3000):
         self.stats['tricks'] = {(f'player-{x}' if not x.startswith('player-') else x): y for (x, y) in
                                 self.stats['tricks'].items()}
 
-        # just make sure tricks exist
-        # + 1 due to range counting behaviour
-        # no matter if '9'-cards are used just create database entries for all 12 possible tricks
-        for trick_number in range(1, 13):
-            trick = self.game.tricks.get(f'{self.id}-{trick_number}')
-            if trick is None:
-                # create trick in CouchDB if it does not exist yet
-                self.game.tricks[f'{self.id}-{trick_number}'] = Trick(trick_id=f'{self.id}-{trick_number}',
-                                                                      game=self.game)
-            # access tricks per trick_count number, not as index starting from 0
-            self.tricks[trick_number] = self.game.tricks[f'{self.id}-{trick_number}']
+        if self.game.db.embed_tricks:
+            self.embed_tricks()
+        else:
+            self.unembed_tricks()
+            # just make sure tricks exist
+            # + 1 due to range counting behaviour
+            # no matter if '9'-cards are used just create database entries for all 12 possible tricks
+            for trick_number in range(1, 13):
+                trick = self.game.tricks.get(f'{self.id}-{trick_number}')
+                if trick is None:
+                    # create trick in CouchDB if it does not exist yet
+                    self.game.tricks[f'{self.id}-{trick_number}'] = Trick(trick_id=f'{self.id}-{trick_number}',
+                                                                          game=self.game)
+                # access tricks per trick_count number, not as index starting from 0
+                self.tricks[trick_number] = self.game.tricks[f'{self.id}-{trick_number}']
+        # tricks may come with cards and owners from database
+        self.count()
 
     @property
     def id(self):
         return self.get('id', '')
 
+    def embed_tricks(self):
+        """
+        keep all 12 tricks as list inside the round document
+        if not done yet existing trick documents are migrated once and deleted afterwards
+        """
+        if 'tricks' not in self:
+            tricks_documents = []
+            for trick_number in range(1, 13):
+                trick_document = {'players': [],
+                                  'cards': [],
+                                  'owner': False}
+                trick = self.game.tricks.get(f'{self.id}-{trick_number}')
+                # an empty trick has a length of 0 so it has to be checked against None
+                if trick is not None:
+                    trick_document.update({x: trick[x] for x in trick_document if x in trick})
+                tricks_documents.append(trick_document)
+            self['tricks'] = tricks_documents
+            # round has to be saved before old tricks are gone
+            self.save()
+            for trick_number in range(1, 13):
+                trick = self.game.tricks.pop(f'{self.id}-{trick_number}', None)
+                if trick is not None:
+                    trick.delete()
+        # access tricks per trick_count number, not as index starting from 0
+        for trick_number, trick_document in enumerate(self['tricks'], start=1):
+            trick = Trick(document=trick_document, game=self.game, round=self)
+            # the trick objects themselves are part of the round document now
+            self['tricks'][trick_number - 1] = trick
+            self.tricks[trick_number] = trick
+
+    def unembed_tricks(self):
+        """
+        move tricks back to their own documents if embedding has been switched off
+        """
+        if 'tricks' in self:
+            for trick_number, trick_document in enumerate(self.pop('tricks'), start=1):
+                trick = self.game.tricks.get(f'{self.id}-{trick_number}')
+                if trick is None:
+                    trick = Trick(trick_id=f'{self.id}-{trick_number}', game=self.game)
+                    self.game.tricks[f'{self.id}-{trick_number}'] = trick
+                trick.update({x: trick_document[x] for x in ['players', 'cards', 'owner'] if x in trick_document})
+                trick.save()
+            self.save()
+
     @property
     def players(self):
         return self.get('players', [])
@@ -556,6 +806,19 @@ class Round(Document3000):
             self['allow_exchange'] = False
         self.save()
 
+    @property
+    def use_rules(self):
+        # better via .get() in case the table is not updated yet
+        return self.get('use_rules', False)
+
+    @use_rules.setter
+    def use_rules(self, value):
+        if type(value) == bool:
+            self['use_rules'] = value
+        else:
+            self['use_rules'] = False
+        self.save()
+
     @property
     def exchange(self):
         return self.get('exchange', {})
@@ -566,8 +829,8 @@ class Round(Document3000):
 
     @property
     def trick_count(self):
-        # just count tricks which already have an owner - this is the number of already played tricks
-        return len([x for x in self.tricks.values() if x.owner])
+        # number of tricks which already have an owner - this is the number of already played tricks
+        return self.counters['trick_count']
 
     @property
     def cards_timestamp(self):
@@ -612,13 +875,9 @@ class Round(Document3000):
     @property
     def played_cards(self):
         """
-        return list of all cards played in this round
+        return list of all cards played in this round - not to be changed by caller
         """
-        played_cards = []
-        for trick in self.tricks.values():
-            for card in trick.cards:
-                played_cards.append(card)
-        return played_cards
+        return self.counters['played_cards']
 
     @property
     def needs_dealing(self):
@@ -649,13 +908,7 @@ class Round(Document3000):
         """
         check if round is over - reached when all cards are played
         """
-        # count number of already played cards
-        played_cards = []
-        # pick tricks with already played cards
-        for trick in [x for x in self.tricks.values() if len(x.cards) > 0]:
-            played_cards += trick.cards
-        # just return if all cards are played or not
-        return len(played_cards) == len(self.cards)
+        return len(self.played_cards) == len(self.cards)
 
     @property
     def is_reset(self):
@@ -685,6 +938,8 @@ class Round(Document3000):
         for trick in self.tricks.values():
             if trick is not None:
                 trick.reset()
+        self.counters = {'trick_count': 0,
+                         'played_cards': []}
         # dynamic order, depending on who gets tricks
         self.trick_order = []
 
@@ -697,15 +952,14 @@ class Round(Document3000):
         # needed for player HUD
         self.calculate_trick_order()
 
-        # reset score and tricks
-        self.calculate_stats()
+        # reset score and tricks - there are no taken tricks yet
+        self.stats['score'] = {x: 0 for x in self.players}
+        self.stats['tricks'] = {x: 0 for x in self.players}
+        self.check_counters()
 
         # a new card deck for every round
         # decide if the '9'-cards are needed and do not give them to round if not
-        if self.with_9:
-            self.cards = list(Deck.cards)
-        else:
-            self.cards = [x.id for x in Deck.cards.values() if x.rank != 'Neun']
+        self.cards = Deck.get_variant(self.with_9)
         # cards per player depend on playing with '9'-cards or not
         self.cards_per_player = len(self.cards) // 4
 
@@ -743,17 +997,12 @@ class Round(Document3000):
         player_count = 0
         for player_id in self.players:
             player = self.game.players[player_id]
-            # reset counter for Eichel Ober cards
-            player.eichel_ober_count = 0
-            for card_id in range(self.cards_per_player):
-                # cards are given to players, segmented by range
-                player.cards = self.cards[player_count * self.cards_per_player:
-                                          player_count * self.cards_per_player +
-                                          self.cards_per_player]
-            # raise counter for Eichel Ober cards if player has one or two
-            for card_id in player.cards:
-                if Deck.cards[card_id].name == 'Eichel-Ober':
-                    player.eichel_ober_count += 1
+            # cards are given to players, segmented by range
+            player.cards = self.cards[player_count * self.cards_per_player:
+                                      player_count * self.cards_per_player +
+                                      self.cards_per_player]
+            # counter for Eichel Ober cards if player has one or two
+            player.eichel_ober_count = Deck.count_eichel_ober(player.get_cards_mask())
 
             # next player
             player_count += 1
@@ -763,10 +1012,68 @@ class Round(Document3000):
         set player as owner of current trick
         """
         # trick_count + 1 is the current trick which will be taken
-        self.game.tricks[f'{self.id}-{self.trick_count + 1}'].owner = player_id
+        self.set_trick_owner(self.trick_count + 1, player_id)
         self.current_player_id = player_id
         self.save()
 
+    def set_trick_owner(self, trick_number, player_id):
+        """
+        give trick to player or take it away if player_id is False, moving its value in stats between owners
+        """
+        trick = self.tricks[trick_number]
+        value = sum(Deck.values[x] for x in trick.cards)
+        if trick.owner:
+            self.stats['score'][trick.owner] = self.stats['score'].get(trick.owner, 0) - value
+            self.stats['tricks'][trick.owner] = self.stats['tricks'].get(trick.owner, 0) - 1
+            self.counters['trick_count'] -= 1
+        trick.owner = player_id
+        if player_id:
+            self.stats['score'][player_id] = self.stats['score'].get(player_id, 0) + value
+            self.stats['tricks'][player_id] = self.stats['tricks'].get(player_id, 0) + 1
+            self.counters['trick_count'] += 1
+        self.save()
+        self.check_counters()
+
+    def add_turn(self, player_id, card_id):
+        """
+        let player play card into current trick
+        """
+        self.current_trick.add_turn(player_id, card_id)
+        self.counters['played_cards'].append(card_id)
+        self.check_counters()
+
+    def count(self):
+        """
+        full recalculation of counters, needed when tricks have been changed from outside like by changes feed
+        """
+        self.counters = self.get_counters()
+
+    def get_counters(self):
+        """
+        count tricks and played cards from scratch
+        """
+        trick_count = 0
+        played_cards = []
+        for trick in self.tricks.values():
+            if trick.owner:
+                trick_count += 1
+            played_cards += trick.cards
+        return {'trick_count': trick_count,
+                'played_cards': played_cards}
+
+    def check_counters(self):
+        """
+        compare counters and stats with full recalculation when debugging them
+        """
+        if CHECK_COUNTERS:
+            # only compared - a wrong result must be visible but not covered up by the check itself
+            counters = self.get_counters()
+            if counters != self.counters:
+                print('ERROR', self.id, 'counters', self.counters, 'differ from', counters)
+            stats = self.get_stats()
+            if stats != self.stats:
+                print('ERROR', self.id, 'stats', self.stats, 'differ from', stats)
+
     def get_current_player_id(self):
         """
         get player for next turn
@@ -833,9 +1140,9 @@ class Round(Document3000):
                 return True
         return False
 
-    def calculate_stats(self):
+    def get_stats(self):
         """
-        get score and tricks count of players for display
+        score and tricks count of players from scratch - normally they are kept up to date by .set_trick_owner()
         """
         score = {}
         tricks = {}
@@ -853,8 +1160,8 @@ class Round(Document3000):
                     tricks[trick.owner] = 0
                 # add number of tricks count to owner
                 tricks[trick.owner] += 1
-        self.stats['score'] = deepcopy(score)
-        self.stats['tricks'] = deepcopy(tricks)
+        return {'score': score,
+                'tricks': tricks}
 
     def calculate_trick_order(self):
         """
@@ -890,24 +1197,24 @@ class Round(Document3000):
         """
         # if already some tricks exist take first player as it started the trick
         if self.current_trick.players:
-            for player_id, card_id in zip(self.current_trick.players, self.current_trick.cards):
-                self.game.players[player_id].cards.append(card_id)
-                # decrease turn_count here to avoid extra self.save() like in increase_turn_count()
-                self.turn_count -= 1
-            self.current_player_id = self.current_trick.players[0]
-            self.current_trick.reset()
+            trick = self.current_trick
         # otherwise the previous trick is to be treated
         else:
-            for player_id, card_id in zip(self.previous_trick.players, self.previous_trick.cards):
-                self.game.players[player_id].cards.append(card_id)
-                # decrease turn_count here to avoid extra self.save() like in increase_turn_count()
-                self.turn_count -= 1
-            self.current_player_id = self.previous_trick.players[0]
-            self.previous_trick.reset()
+            trick = self.previous_trick
+            # previous trick loses its owner and its share of stats
+            self.set_trick_owner(self.trick_count, False)
+        for player_id, card_id in zip(trick.players, trick.cards):
+            # assigning the extended hand lets player forget its mask
+            self.game.players[player_id].cards += [card_id]
+            # decrease turn_count here to avoid extra self.save() like in increase_turn_count()
+            self.turn_count -= 1
+        # cards of undone trick are the last ones played
+        del self.counters['played_cards'][len(self.counters['played_cards']) - len(trick.cards):]
+        self.current_player_id = trick.players[0]
+        trick.reset()
+        self.check_counters()
         # trick order has to be fixed
         self.calculate_trick_order()
-        # recalculate statistics due to reverted ownerships
-        self.calculate_stats()
         # finally save undone trick
         self.save()
 
@@ -920,9 +1227,13 @@ class Table(Document3000):
     def __init__(self, name='', document=None, game=None):
         # access to global game
         self.game = game
+        # players split into active ones and spectators, created when needed
+        self.partitions = None
+        # HTML fragments rendered for current state of table, keyed by sync count, template and mode
+        self.fragments = {}
         if name:
             self['_id'] = self.game.create_table_id()
-            super().__init__(database=self.game.db.database)
+            super().__init__(db=self.game.db)
             # type is for CouchDB
             self['type'] = 'table'
             # what table?
@@ -937,9 +1248,11 @@ class Table(Document3000):
             self['locked'] = False
             self['is_debugging'] = False
         elif document:
-            super().__init__(database=self.game.db.database, document_id=document['_id'])
+            super().__init__(db=self.game.db, document_id=document['_id'])
             # get data from given document
             self.update(document)
+            # loaded content does not need to be saved again
+            self.mark_saved()
         # id migration fix - prepend "player-"
         # pretty silly but pragmatical, because the user base might be pretty small still
         # so no big problems are to be expected
@@ -950,6 +1263,18 @@ class Table(Document3000):
         if self.id not in self.game.rounds:
             self.add_round()
 
+    def __getstate__(self):
+        """
+        rendered fragments do not belong into a snapshot
+        """
+        state = super().__getstate__()
+        state.pop('fragments', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fragments = {}
+
     @property
     def id(self):
         # meanwhile returns CouchDB ID
@@ -965,6 +1290,13 @@ class Table(Document3000):
         else:
             return name
 
+    @name.setter
+    def name(self, value):
+        old_name = self.name
+        self['name'] = value
+        self.game.update_name_index(self, old_name)
+        self.save()
+
     @property
     def order(self):
         return self['order']
@@ -972,6 +1304,8 @@ class Table(Document3000):
     @order.setter
     def order(self, value):
         self['order'] = value
+        # idle players are shown depending on order
+        self.forget_fragments()
 
     @property
     def round(self):
@@ -988,6 +1322,7 @@ class Table(Document3000):
     @players.setter
     def players(self, value):
         self['players'] = value
+        self.players_changed()
 
     @property
     def players_ready(self):
@@ -1009,14 +1344,43 @@ class Table(Document3000):
         """
         access all players willing to play
         """
-        return [x for x in self['players'] if not self.game.players[x].is_spectator_only]
+        return self.get_partitions()['active']
 
     @property
     def players_spectator_only(self):
         """
         all players which are only watching
         """
-        return [x for x in self['players'] if self.game.players[x].is_spectator_only]
+        return self.get_partitions()['spectator_only']
+
+    def get_partitions(self):
+        """
+        split players into active ones and spectators only once until players change
+        lists are shared and not to be changed by caller
+        """
+        if self.partitions is None:
+            self.partitions = {'active': [],
+                               'spectator_only': []}
+            for player_id in self['players']:
+                if self.game.players[player_id].is_spectator_only:
+                    self.partitions['spectator_only'].append(player_id)
+                else:
+                    self.partitions['active'].append(player_id)
+        return self.partitions
+
+    def players_changed(self):
+        """
+        to be called whenever players are changed - keeps index of players in game up to date
+        """
+        self.partitions = None
+        self.forget_fragments()
+        self.game.index_players(self.id, self['players'])
+
+    def forget_fragments(self):
+        """
+        rendered fragments are outdated - to be called if something changes which does not increase sync count
+        """
+        self.fragments.clear()
 
     @property
     def players_idle(self):
@@ -1090,6 +1454,10 @@ class Table(Document3000):
         to be called after various actions
         """
         self['sync_count'] += 1
+        # everything rendered before shows an older state
+        self.forget_fragments()
+        # other processes sharing the database need to know the sync count too
+        self.save()
         # just return new sync count to have it ready for use
         return self['sync_count']
 
@@ -1098,6 +1466,7 @@ class Table(Document3000):
         initial count
         """
         self['sync_count'] = 0
+        self.forget_fragments()
 
     def add_player(self, player_id):
         """
@@ -1105,6 +1474,7 @@ class Table(Document3000):
         """
         if player_id not in self.players:
             self.players.append(player_id)
+            self.players_changed()
             # only a real player makes sense to be listed in order
             if not self.game.players[player_id].is_spectator_only:
                 self.order.append(player_id)
@@ -1127,6 +1497,7 @@ class Table(Document3000):
         # make sure really no trace of player sticks somewhere
         while player_id in self.players:
             self.players.pop(self.players.index(player_id))
+        self.players_changed()
         while player_id in self.order:
             self.order.pop(self.order.index(player_id))
         while player_id in self.round.players:
@@ -1220,19 +1591,138 @@ class Table(Document3000):
         print(args)
 
 
+class Rounds(dict):
+    """
+    rounds of all tables - stored ones are only loaded from CouchDB when they are accessed
+    """
+
+    def __init__(self, game=None):
+        super().__init__()
+        self.game = game
+        # IDs of rounds which exist in CouchDB but are not in memory
+        self.stored = set()
+        # last access of every round in memory to find idle ones
+        self.last_access = {}
+
+    def __getitem__(self, round_id):
+        round = super().__getitem__(round_id)
+        self.last_access[round_id] = time()
+        return round
+
+    def __setitem__(self, round_id, value):
+        self.stored.discard(round_id)
+        self.last_access[round_id] = time()
+        super().__setitem__(round_id, value)
+
+    def __missing__(self, round_id):
+        if round_id not in self.stored:
+            raise KeyError(round_id)
+        self.game.load_round(round_id)
+        return super().__getitem__(round_id)
+
+    def __contains__(self, round_id):
+        return super().__contains__(round_id) or round_id in self.stored
+
+    def get(self, round_id, default=None):
+        try:
+            return self[round_id]
+        except KeyError:
+            return default
+
+    def pop(self, round_id, *default):
+        self.stored.discard(round_id)
+        self.last_access.pop(round_id, None)
+        return super().pop(round_id, *default)
+
+    def is_loaded(self, round_id):
+        """
+        check without loading if round is in memory
+        """
+        return super().__contains__(round_id)
+
+    def evict(self, round_id):
+        """
+        drop round from memory - it stays in CouchDB and can be loaded again
+        """
+        super().pop(round_id)
+        self.last_access.pop(round_id, None)
+        self.stored.add(round_id)
+
+
+class IDs(Document3000):
+    """
+    persisted counters for player and table IDs - they only grow so IDs of deleted items are not given again
+    """
+
+    def __init__(self, game=None):
+        self.game = game
+        super().__init__(db=self.game.db, document_id='ids')
+        document = self.game.db.load_document(self.id)
+        if document:
+            self.update(document)
+            # loaded content does not need to be saved again
+            self.mark_saved()
+
+    @property
+    def id(self):
+        return self.get('_id')
+
+    def create_id(self, document_type, items):
+        """
+        count up ID of given document type - items are checked for IDs given before counting or by other processes
+        in a shared database the counter is written at once so a conflict tells that another process took the same ID
+        meanwhile, otherwise it is saved like every other document
+        """
+        while True:
+            number = self.get(document_type, 0) + 1
+            while f'{document_type}-{number}' in items:
+                number += 1
+            self[document_type] = number
+            if not self.db.shared:
+                self.save()
+                return f'{document_type}-{number}'
+            conflicts = []
+            # if storage is unreachable the counter gets queued and only this process knows about the ID
+            self.db.queue(self.db.save_documents([self], conflicts=conflicts))
+            if not conflicts:
+                return f'{document_type}-{number}'
+            # count on from the counter of the other process
+            document = self.db.load_document(self.id) or {'_id': self.id}
+            self.clear()
+            self.update(document)
+            self.mark_saved()
+
+
 class Game:
     """
     organizes tables
     """
 
-    def __init__(self, db=None):
+    def __init__(self, db=None, table_idle_timeout=0, snapshot_path='', version=''):
         """
         access to game DB and cards deck
         """
         self.db = db
+        # documents changed meanwhile by another process get merged like those from the changes feed
+        self.db.conflict_handler = self.apply_changes
+        # seconds after which rounds of tables without connected players are dropped from memory - 0 keeps all
+        self.table_idle_timeout = table_idle_timeout
+        # snapshot of game objects for fast restarts, only of use if the database offers its changes
+        if snapshot_path and self.db.backend.changes_feed:
+            self.snapshot_path = Path(snapshot_path)
+        else:
+            self.snapshot_path = None
+        # snapshots of other versions might not fit
+        self.version = version
         self.deck = Deck()
-        # load game objects from CouchDB
-        self.load_from_db()
+        # documents left in write-behind journal after a crash have to reach CouchDB before loading
+        if self.db.write_behind:
+            self.db.write_behind.replay()
+        # counters for new player and table IDs
+        self.ids = IDs(game=self)
+        # load game objects from snapshot and changes since then or completely from CouchDB
+        if not self.load_snapshot():
+            self.load_from_db()
 
     @property
     def needs_welcome(self):
@@ -1248,10 +1738,26 @@ class Game:
         """
         initialize all game components like tables and players
         """
+        # get all documents from CouchDB in one pass
+        time_start = time()
+        if self.table_idle_timeout:
+            # rounds and tricks are loaded when their table is accessed - only their IDs are needed now
+            documents = self.db.load_documents(prefixes=['player-', 'table-'])
+            documents.update(round=self.db.load_documents(prefixes=['round-'], include_docs=False)['round'])
+        else:
+            documents = self.db.load_documents()
+        print('INFO', f'loaded {sum(len(x) for x in documents.values())} documents in {time() - time_start:.3f}s')
+
         # get players from CouchDB
+        time_start = time()
         self.players = {}
-        for player_id, document in self.db.filter_by_type_real_id('player').items():
+        # index of players at tables gets filled when tables are created
+        self.player_tables = {}
+        self.table_players = {}
+        for player_id, document in documents['player'].items():
             self.players[player_id] = Player(document=document, game=self)
+        self.player_names = self.index_names(self.players)
+        self.log_load_time('player', time_start)
 
         # if no player exists create a dummy admin account
         if len(self.players) == 0:
@@ -1262,20 +1768,29 @@ class Game:
                             allows_spectators=True)
 
         # all tricks belonging to certain rounds shall stay in CouchDB too
+        time_start = time()
         self.tricks = {}
-        for trick_id, document in self.db.filter_by_type_as_number('trick').items():
+        for trick_id, document in documents['trick'].items():
             self.tricks[trick_id] = Trick(document=document, game=self)
+        self.log_load_time('trick', time_start)
 
         # get rounds from CouchDB
-        self.rounds = {}
-        # for round_id, document in self.db.filter_by_type_as_number('round').items():
-        for round_id, document in self.db.filter_by_type_as_number('round').items():
-            self.rounds[round_id] = Round(document=document, game=self)
+        time_start = time()
+        self.rounds = Rounds(game=self)
+        for round_id, document in documents['round'].items():
+            if document is None:
+                self.rounds.stored.add(round_id)
+            else:
+                self.rounds[round_id] = Round(document=document, game=self)
+        self.log_load_time('round', time_start)
 
         # store tables
+        time_start = time()
         self.tables = {}
-        for table_id, document in self.db.filter_by_type_real_id('table').items():
+        for table_id, document in documents['table'].items():
             self.tables[table_id] = Table(document=document, game=self)
+        self.table_names = self.index_names(self.tables)
+        self.log_load_time('table', time_start)
 
         # remove legacy URL-encoded IDs
         self.cleanup_ids()
@@ -1283,15 +1798,234 @@ class Game:
         # check for locked tables
         self.check_tables()
 
+    def save_snapshot(self):
+        """
+        store all game objects in one compressed file, tagged with the database sequence they belong to
+        """
+        if not self.snapshot_path:
+            return
+        time_start = time()
+        try:
+            # sequence taken before pickling - changes made meanwhile will be applied again which does no harm
+            snapshot = {'format': SNAPSHOT_FORMAT,
+                        'version': self.version,
+                        'database': self.db.backend.url,
+                        'update_seq': self.db.backend.update_seq(),
+                        'players': self.players,
+                        'tables': self.tables,
+                        'rounds': dict(self.rounds),
+                        'rounds_stored': self.rounds.stored,
+                        'tricks': self.tricks}
+            data = compress(pickle_dumps(snapshot, protocol=HIGHEST_PROTOCOL))
+            # replaced atomically to always have a complete snapshot
+            path_new = self.snapshot_path.with_name(f'{self.snapshot_path.name}.new')
+            with path_new.open('wb') as snapshot_file:
+                snapshot_file.write(data)
+                snapshot_file.flush()
+                fsync(snapshot_file.fileno())
+            replace(path_new, self.snapshot_path)
+        except Exception as error:
+            print('ERROR', 'snapshot', self.snapshot_path)
+            print(error)
+            return
+        print('INFO', f'saved snapshot {self.snapshot_path} with {len(data)} bytes in {time() - time_start:.3f}s')
+
+    def load_snapshot(self):
+        """
+        restore game objects from snapshot and apply changes made in database since it was taken
+        returns False if there is no usable snapshot and everything has to be loaded from database
+        """
+        if not self.snapshot_path or \
+                not self.snapshot_path.exists():
+            return False
+        time_start = time()
+        try:
+            snapshot = pickle_loads(decompress(self.snapshot_path.read_bytes()))
+            # a database sequence behind the snapshot one means the database has been replaced meanwhile
+            update_seq = self.db.backend.update_seq()
+            if snapshot.get('format') != SNAPSHOT_FORMAT or \
+                    snapshot.get('version') != self.version or \
+                    snapshot.get('database') != self.db.backend.url or \
+                    int(str(update_seq).split('-')[0]) < int(str(snapshot['update_seq']).split('-')[0]):
+                print('INFO', f'snapshot {self.snapshot_path} does not fit and is ignored')
+                return False
+            changes, _ = self.db.backend.changes(snapshot['update_seq'])
+        except Exception as error:
+            print('ERROR', 'snapshot', self.snapshot_path)
+            print(error)
+            return False
+        self.players = snapshot['players']
+        self.tables = snapshot['tables']
+        self.tricks = snapshot['tricks']
+        self.rounds = Rounds(game=self)
+        for round_id, round in snapshot['rounds'].items():
+            self.rounds[round_id] = round
+        self.rounds.stored.update(snapshot['rounds_stored'])
+        # reconnect objects to game and database
+        objects = list(self.players.values()) + list(self.tables.values()) + list(self.tricks.values())
+        for round in self.rounds.values():
+            objects += [round] + list(round.tricks.values())
+        for item in objects:
+            item.game = self
+            item.db = self.db
+        self.player_names = self.index_names(self.players)
+        self.table_names = self.index_names(self.tables)
+        self.player_tables = {}
+        self.table_players = {}
+        for table in self.tables.values():
+            table.players_changed()
+        self.apply_changes(changes)
+        print('INFO', f'loaded snapshot {self.snapshot_path} and applied {len(changes)} changes '
+                      f'in {time() - time_start:.3f}s')
+        self.check_tables()
+        return True
+
+    def log_load_time(self, document_type, time_start):
+        """
+        report how long building objects of one type took at startup
+        """
+        count = len(getattr(self, f'{document_type}s'))
+        print('INFO', f'created {count} {document_type}s in {time() - time_start:.3f}s')
+
+    def load_round(self, round_id):
+        """
+        load round of a table and its tricks from CouchDB when it is needed
+        """
+        time_start = time()
+        document = self.db.load_document(f'round-{round_id}')
+        if document is None:
+            # vanished meanwhile - table will get a new one
+            self.rounds.stored.discard(round_id)
+            raise KeyError(round_id)
+        # trick documents are needed too if tricks are not embedded yet
+        if not self.db.embed_tricks or 'tricks' not in document:
+            tricks_documents = self.db.load_documents(prefixes=[f'trick-{round_id}-'])['trick']
+            for trick_id, trick_document in tricks_documents.items():
+                self.tricks[trick_id] = Trick(document=trick_document, game=self)
+        round = Round(document=document, game=self)
+        # players might have been deleted while round was stored
+        for players in [round['players'], round.get('trick_order') or []]:
+            for player in list(players):
+                if player not in self.players:
+                    players.remove(player)
+        self.rounds[round_id] = round
+        print('INFO', f'loaded round {round_id} in {time() - time_start:.3f}s')
+
+    def evict_idle_rounds(self, players_connected):
+        """
+        drop rounds and tricks of tables from memory which nobody has accessed for a while
+        tables themselves stay as lightweight lobby summary
+        """
+        for round_id, last_access in sorted(self.rounds.last_access.items(), key=lambda x: x[1]):
+            if time() - last_access < self.table_idle_timeout:
+                # sorted by last access so all following rounds are even younger
+                break
+            table = self.tables.get(round_id)
+            if table and set(table.players) & players_connected:
+                continue
+            trick_ids = [f'{round_id}-{x}' for x in range(1, 13)]
+            # documents being written, not yet written in write-behind mode or queued while storage is unreachable must stay
+            if any(self.db.is_busy(x) or x in self.db.queued
+                   for x in [f'round-{round_id}'] + [f'trick-{x}' for x in trick_ids]):
+                continue
+            self.rounds.evict(round_id)
+            if table:
+                table.forget_fragments()
+            for trick_id in trick_ids:
+                self.tricks.pop(trick_id, None)
+            print('INFO', f'evicted round {round_id}')
+
+    def apply_changes(self, changes):
+        """
+        bring documents changed by other processes sharing the database into memory
+        """
+        # rounds need their tricks and tables their rounds, so apply changes in this order
+        order = ['player', 'trick', 'round', 'table']
+        for change in sorted(changes, key=lambda x: order.index(x['id'].partition('-')[0])
+                             if x['id'].partition('-')[0] in order else len(order)):
+            self.apply_change(change)
+
+    def apply_change(self, change):
+        """
+        apply one single change from CouchDB _changes feed - own changes are already there and get skipped
+        """
+        if change['id'] == self.ids.id:
+            # other processes sharing the database count IDs too
+            generation = int(change['changes'][0]['rev'].split('-')[0])
+            if not change.get('deleted') and \
+                    generation > int(self.ids.get('_rev', '0-').split('-')[0]) and \
+                    not self.db.is_busy(self.ids.id):
+                self.ids.clear()
+                self.ids.update(change['doc'])
+                self.ids.mark_saved()
+            return
+        document_type, _, item_id = change['id'].partition('-')
+        # design documents and whatever else does not belong to the game are ignored
+        if document_type not in DOCUMENT_TYPES or not item_id:
+            return
+        if document_type in ['player', 'table']:
+            item_id = change['id']
+        objects = getattr(self, f'{document_type}s')
+        # stored rounds will be loaded fresh anyway when needed
+        if document_type == 'round' and \
+                item_id in self.rounds.stored and \
+                not change.get('deleted'):
+            return
+        # dict.get() does not trigger loading of stored rounds
+        current = dict.get(objects, item_id)
+        if current is not None:
+            # revision generations tell if the change is newer than what is in memory, e.g. not an own one
+            generation = int(change['changes'][0]['rev'].split('-')[0])
+            if generation <= int(current.get('_rev', '0-').split('-')[0]) or \
+                    self.db.is_busy(change['id']):
+                return
+        # names of players and tables might change or vanish
+        old_name = current.name if document_type in ['player', 'table'] and current is not None else None
+        if change.get('deleted'):
+            objects.pop(item_id, None)
+            if old_name is not None:
+                self.remove_name(current, old_name)
+            if document_type == 'table':
+                self.index_players(item_id, [])
+        elif document_type == 'round':
+            # round has to care about its tricks and cards so it is rebuilt
+            self.rounds[item_id] = Round(document=change['doc'], game=self)
+        elif current is not None:
+            # players, tables and tricks are referenced elsewhere so they get updated in place
+            current.clear()
+            current.update(change['doc'])
+            current.mark_saved()
+            if document_type == 'table':
+                current.players_changed()
+            elif document_type == 'player':
+                self.player_changed(item_id)
+        else:
+            objects[item_id] = {'player': Player,
+                                'trick': Trick,
+                                'table': Table}[document_type](document=change['doc'], game=self)
+        if document_type in ['player', 'table'] and not change.get('deleted'):
+            self.update_name_index(objects[item_id], old_name)
+        if document_type == 'trick':
+            # counters of round of changed trick are not valid anymore
+            round = dict.get(self.rounds, item_id.rpartition('-')[0])
+            if round is not None:
+                round.count()
+        if document_type in ['round', 'trick']:
+            # rounds belong to the table with the same ID
+            table = self.tables.get(item_id.rpartition('-')[0] if document_type == 'trick' else item_id)
+            if table is not None:
+                table.forget_fragments()
+
     def add_player(self, name='', password='', is_spectator_only=False, allows_spectators=False, is_admin=False,
                    convert=False):
         """
         adds a new player
         """
         if name:
-            if name not in [x.name for x in self.players.values()] or convert:
+            if name.casefold() not in self.player_names or convert:
                 player = Player(name=name, game=self)
                 self.players[player.id] = player
+                self.update_name_index(player)
                 if password:
                     self.players[player.id].set_password(password)
                 if is_admin:
@@ -1308,9 +2042,10 @@ class Game:
         adds a new table (to sit and play on, no database table!)
         """
         if name:
-            if name not in [x.name for x in self.tables.values()] or convert:
+            if name.casefold() not in self.table_names or convert:
                 table = Table(name=name, game=self)
                 self.tables[table.id] = table
+                self.update_name_index(table)
                 # return table object to get its ID for example
                 return table
         # when no name was given
@@ -1320,46 +2055,133 @@ class Game:
         """
         remove all traces of a player which is going to be deleted
         """
-        for table in self.tables.values():
-            if player_id in table.players:
-                table.players.pop(table.players.index(player_id))
-                table.save()
-            if player_id in table.order:
-                table.order.pop(table.order.index(player_id))
-                table.save()
-        for round in self.rounds.values():
-            if player_id in round.players:
-                round.players.pop(round.players.index(player_id))
-                round.save()
-            if player_id in round.trick_order:
-                round.trick_order.pop(round.trick_order.index(player_id))
+        player = self.players.get(player_id)
+        if player is None:
+            return False
+        # index knows the table player sits at, the player itself might still know an older one
+        for table_id in {self.player_tables.get(player_id), player.table}:
+            table = self.tables.get(table_id)
+            if table:
+                if player_id in table.players:
+                    table.players.pop(table.players.index(player_id))
+                    table.players_changed()
+                    table.save()
+                if player_id in table.order:
+                    table.order.pop(table.order.index(player_id))
+                    table.save()
+        # rounds in memory are cleaned directly without loading any stored one
+        for round in dict.values(self.rounds):
+            self.remove_round_player(round, player_id)
+        # stored rounds are only checked as documents in one pass - loading them as rounds cleans them anyway
+        if self.rounds.stored:
+            try:
+                documents = self.db.load_documents(prefixes=['round-'])['round']
+            except StorageUnavailable:
+                print('ERROR', 'could not check stored rounds for player', player_id)
+                documents = {}
+            for round_id, document in documents.items():
+                if round_id in self.rounds.stored and \
+                        player_id in document.get('players', []) + (document.get('trick_order') or []):
+                    round = Document3000(db=self.db, document_id=document['_id'])
+                    round.update(document)
+                    round.mark_saved()
+                    self.remove_round_player(round, player_id)
+        player.delete()
+        self.players.pop(player_id)
+        self.remove_name(player, player.name)
+        return True
+
+    @staticmethod
+    def remove_round_player(round, player_id):
+        """
+        take player out of round or its stored document
+        """
+        for key in ['players', 'trick_order']:
+            if player_id in (round.get(key) or []):
+                round[key].remove(player_id)
                 round.save()
-        if player_id in self.players:
-            self.players[player_id].delete()
-            self.players.pop(player_id)
-            return True
-        return False
 
     def get_player(self, name):
         """
         check if player with this name already exists
         """
-        # filter players
-        players_list = [x for x in self.players.values() if x.name == name]
-        if len(players_list) == 1:
-            return players_list[0]
-        return False
+        return self.find_name(self.players, self.player_names, name)
 
     def get_table(self, name):
         """
         check if table with this name already exists
         """
-        # filter tables
-        tables_list = [x for x in self.tables.values() if x.name == name]
-        if len(tables_list) == 1:
-            return tables_list[0]
+        return self.find_name(self.tables, self.table_names, name)
+
+    def index_players(self, table_id, player_ids):
+        """
+        keep reverse index of which player sits at which table up to date
+        """
+        for player_id in self.table_players.get(table_id, set()).difference(player_ids):
+            if self.player_tables.get(player_id) == table_id:
+                self.player_tables.pop(player_id)
+        for player_id in player_ids:
+            self.player_tables[player_id] = table_id
+        if player_ids:
+            self.table_players[table_id] = set(player_ids)
+        else:
+            self.table_players.pop(table_id, None)
+
+    def player_changed(self, player_id):
+        """
+        table of player has to split its players again if player became spectator or vice versa
+        and render them again if name or visibility of cards changed
+        """
+        table_id = self.player_tables.get(player_id)
+        if table_id is not None and \
+                table_id in self.tables:
+            self.tables[table_id].partitions = None
+            self.tables[table_id].forget_fragments()
+
+    @staticmethod
+    def index_names(items):
+        """
+        map names of players or tables to their IDs to find them by name without looking at all of them
+        names differing only in case are the same, so 'Bob' cannot join as 'bob'
+        """
+        names = {}
+        for item in items.values():
+            names.setdefault(item.name.casefold(), set()).add(item.id)
+        return names
+
+    @staticmethod
+    def find_name(items, names, name):
+        """
+        get player or table by name - exact spelling wins if older ones only differ in case
+        """
+        item_ids = names.get(name.casefold(), set())
+        if len(item_ids) > 1:
+            item_ids = {x for x in item_ids if items[x].name == name}
+        # names are expected to be unique - if not the item cannot be told apart
+        if len(item_ids) == 1:
+            return items[next(iter(item_ids))]
         return False
 
+    def update_name_index(self, item, old_name=None):
+        """
+        keep index of names up to date when a player or table is added or renamed
+        """
+        if old_name is not None:
+            self.remove_name(item, old_name)
+        names = self.player_names if isinstance(item, Player) else self.table_names
+        names.setdefault(item.name.casefold(), set()).add(item.id)
+
+    def remove_name(self, item, name):
+        """
+        remove name of deleted or renamed player or table from index
+        """
+        names = self.player_names if isinstance(item, Player) else self.table_names
+        item_ids = names.get(name.casefold())
+        if item_ids is not None:
+            item_ids.discard(item.id)
+            if not item_ids:
+                names.pop(name.casefold())
+
     def delete_table(self, table_id):
         """
         remove all traces of a table and its round
@@ -1380,7 +2202,8 @@ class Game:
                 self.rounds.pop(table_id)
             if table_id in self.tables:
                 self.tables[table_id].delete()
-                self.tables.pop(table_id)
+                self.remove_name(self.tables.pop(table_id), table.name)
+                self.index_players(table_id, [])
             for trick in range(1, 13):
                 if f'trick-{table_id}-{trick}' in self.tricks:
                     self.tricks[f'trick-{table_id}-{trick}'].delete()
@@ -1399,21 +2222,15 @@ class Game:
 
     def create_player_id(self):
         """
-        creates id for player and checks if it already exists
+        creates id for player
         """
-        player_id = 1
-        while f'player-{player_id}' in self.players:
-            player_id += 1
-        return f'player-{player_id}'
+        return self.ids.create_id('player', self.players)
 
     def create_table_id(self):
         """
-        creates id for table and checks if it already exists
+        creates id for table
         """
-        table_id = 1
-        while f'table-{table_id}' in self.tables:
-            table_id += 1
-        return f'table-{str(table_id)}'
+        return self.ids.create_id('table', self.tables)
 
     def cleanup_ids(self):
         """
@@ -1432,7 +2249,12 @@ class Game:
                 # kick it out
                 self.delete_table(table.id)
             else:
-                for players in [table['players'], table['order'], table.round['players']]:
+                players_lists = [table['players'], table['order']]
+                # stored rounds get cleaned when they are loaded
+                if self.rounds.is_loaded(table.id):
+                    players_lists.append(table.round['players'])
+                for players in players_lists:
                     for player in list(players):
                         if not player in self.players:
                             players.remove(player)
+                table.players_changed()
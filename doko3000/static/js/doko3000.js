@@ -8,6 +8,8 @@ let current_player_id = ''
 let cards_locked = false
 // table mode, might be normal or exchange
 let table_mode = 'normal'
+// version of state deltas understood by this script
+const protocol_version = 2
 
 // show alert messages
 function show_message(place, message) {
@@ -26,6 +28,11 @@ function show_dialog(html) {
 
 // check if message is in sync
 function check_sync(msg) {
+    // state deltas of another version come from a newer server - reload to get the matching script
+    if (msg.protocol && msg.protocol != protocol_version) {
+        location.reload()
+        return false
+    }
     // if not set yet take sync_count from freshly loaded HTML id
     console.log('sync_count', sync_count)
     if (sync_count == 0) {
@@ -43,6 +50,16 @@ function check_sync(msg) {
     }
 }
 
+// lists in lobby are the same for everybody, only players of locked tables and admins may enter them
+function enable_locked_tables() {
+    let lobby_player = $('#lobby_player')
+    $('.table-locked').each(function () {
+        if (lobby_player.data('is_admin') || $(this).data('players').includes(lobby_player.data('player_id'))) {
+            $(this).find('.disabled').removeClass('disabled')
+        }
+    })
+}
+
 // check if normal player or spectator
 function is_normal_player() {
     if ($('.mode-spectator').hasClass('d-none')) {
@@ -52,6 +69,90 @@ function is_normal_player() {
     }
 }
 
+// create played card like cards/card.html does
+function render_card(msg) {
+    let card = $('<div>', {
+        id: 'card_' + msg.card_id,
+        class: 'game-card game-card-hand',
+        'data-name': msg.card_name,
+        'data-id': msg.card_id,
+        'data-table_id': msg.table_id,
+        'data-cards_timestamp': $('#cards_table_timestamp').data('cards_timestamp'),
+        title: msg.player_name
+    })
+    let img = $('<img>', {
+        class: 'img-fluid p-1',
+        src: '/static/img/cards/' + msg.card_name + '.' + $('#deck').data('file_extension')
+    })
+    return card.append($('<picture>').append(img))
+}
+
+// update HUD like top/hud_players.html does - trick_order and tricks only come with a new trick
+function update_hud(msg) {
+    if (msg.trick_order) {
+        // winner of last trick starts the new one
+        let hud = $('.hud_player').first().parent()
+        for (let hud_player_id of msg.trick_order.slice().reverse()) {
+            hud.prepend($('#hud_player_' + hud_player_id))
+        }
+    }
+    $('.hud_player').removeClass('hud-player-current')
+    if (!msg.is_last_turn) {
+        $('#hud_player_' + msg.current_player_id).addClass('hud-player-current')
+    }
+    $('.hud_player').each(function () {
+        let badge = $(this).children('.badge')
+        if (msg.tricks) {
+            let tricks = msg.tricks[this.id.replace('hud_player_', '')]
+            if (tricks > 0) {
+                if (badge.length == 0) {
+                    badge = $('<span>', {class: 'badge align-text-top ml-1'}).appendTo(this)
+                }
+                badge.text(tricks)
+            } else {
+                badge.remove()
+            }
+        }
+        badge.toggleClass('badge-dark', $(this).hasClass('hud-player-current'))
+        badge.toggleClass('badge-light', !$(this).hasClass('hud-player-current'))
+    })
+}
+
+// clear table for next trick
+function show_next_trick(msg) {
+    current_player_id = msg.current_player_id
+    cards_locked = false
+    if (msg.html) {
+        $('#table').html(msg.html.cards_table)
+        // the HUD
+        $('#hud_players').html(msg.html.hud_players)
+    } else {
+        // state delta - timestamp of cards on table stays
+        $('#table').children('.game-card').remove()
+        update_hud(msg)
+    }
+    if (player_id == current_player_id) {
+        $('#turn_indicator').removeClass('d-none')
+    } else {
+        $('#turn_indicator').addClass('d-none')
+    }
+    // cards stack of gained tricks
+    if (msg.score[player_id] > 0) {
+        $('#cards_stack_img').attr('title', msg.score[player_id])
+        $('#cards_stack').removeClass('d-none')
+    } else {
+        $('#cards_stack').addClass('d-none')
+    }
+    // highlight current player for spectators view
+    if (!is_normal_player()) {
+        // indicate current player in spectator overview
+        $('.spectator-player').removeClass('spectator-current-player')
+        if (!msg.is_last_turn) {
+            $('#spectator_player_' + msg.current_player_id).addClass('spectator-current-player')
+        }
+    }
+}
+
 $(document).ready(function () {
         // initialize SocketIO
         const socket = io({
@@ -180,6 +281,9 @@ $(document).ready(function () {
                 )
             }
         }
+
+        // lobby list of tables comes the same for everybody
+        enable_locked_tables()
 //
 // ------------ Socket.io events ------------
 //
@@ -188,11 +292,18 @@ $(document).ready(function () {
         socket.on('connect', function () {
             // validate user ID and sync state
             socket.emit('who-am-i')
+            // lists in lobby get pushed when they change
+            if (!location.pathname.startsWith('/table/')) {
+                socket.emit('enter-lobby')
+            }
         })
 
         socket.on('reconnect', function () {
             // revalidate user ID and sync state
             socket.emit('who-am-i')
+            if (!location.pathname.startsWith('/table/')) {
+                socket.emit('enter-lobby')
+            }
         })
 
         // answer on 'who-am-i'
@@ -231,13 +342,30 @@ $(document).ready(function () {
         socket.on('card-played-by-player', function (msg) {
             if (check_sync(msg)) {
                 current_player_id = msg.current_player_id
-                $('#hud_players').html(msg.html.hud_players)
                 $('.overlay-button').addClass('d-none')
 
-                // either #table_spectator or #table are visible and may show the cards on table
-                if (is_normal_player()) {
+                if (!msg.html) {
+                    // state delta - only the played card is new
+                    update_hud(msg)
+                    if (is_normal_player()) {
+                        // player who played the card already dragged it onto the table
+                        $('#table').children('#card_' + msg.card_id).remove()
+                        $('#table').append(render_card(msg))
+                    } else {
+                        $('.spectator-player').removeClass('spectator-current-player')
+                        if (!msg.is_last_turn) {
+                            $('#spectator_player_' + msg.current_player_id).addClass('spectator-current-player')
+                        }
+                        // card leaves hand of player in spectator overview
+                        $('.card_' + msg.card_id).remove()
+                        $('#table_spectator').append(render_card(msg))
+                    }
+                } else if (is_normal_player()) {
+                    // either #table_spectator or #table are visible and may show the cards on table
+                    $('#hud_players').html(msg.html.hud_players)
                     $('#table').html(msg.html.cards_table)
                 } else {
+                    $('#hud_players').html(msg.html.hud_players)
                     // indicate current player in spectator overview
                     $('.spectator-player').removeClass('spectator-current-player')
                     if (!msg.is_last_turn) {
@@ -255,7 +383,8 @@ $(document).ready(function () {
             if (msg.is_last_turn) {
                 cards_locked = true
                 $('#turn_indicator').addClass('d-none')
-                if (!msg.players_idle.includes(player_id) && !msg.players_spectator_only.includes(player_id)) {
+                // with rules the trick goes to its winner without claiming
+                if (!msg.players_idle.includes(player_id) && !msg.players_spectator_only.includes(player_id) && !msg.use_rules) {
                     $('#button_claim_trick').removeClass('d-none').fadeOut(1).delay(1500).fadeIn(1)
                 }
             } else if (msg.player_showing_hand) {
@@ -275,15 +404,7 @@ $(document).ready(function () {
             $('#button_deal_cards_again').addClass('d-none')
         })
 
-        // told to every player of current round to ask for cards
-        socket.on('grab-your-cards', function (msg) {
-            socket.emit('my-cards-please', {
-                player_id: player_id,
-                table_id: msg.table_id
-            })
-        })
-
-        // answer to my-cards-please
+        // pushed after dealing or answer to my-cards-please
         socket.on('your-cards-please', function (msg) {
             current_player_id = msg.current_player_id
             if (check_sync(msg)) {
@@ -335,7 +456,7 @@ $(document).ready(function () {
             }
         })
 
-        // anser to my-cards-please if player is only spectator
+        // pushed after dealing or anser to my-cards-please if player is only spectator
         socket.on('sorry-no-cards-for-you', function (msg) {
             if (check_sync(msg)) {
                 $('#modal_dialog').modal('hide')
@@ -360,31 +481,8 @@ $(document).ready(function () {
         // sent after someone claimed a trick
         socket.on('next-trick', function (msg) {
             if (check_sync(msg)) {
-                current_player_id = msg.current_player_id
-                cards_locked = false
-                $('#table').html(msg.html.cards_table)
-                if (player_id == current_player_id) {
-                    $('#turn_indicator').removeClass('d-none')
-                } else {
-                    $('#turn_indicator').addClass('d-none')
-                }
-                // the HUD
-                $('#hud_players').html(msg.html.hud_players)
-                // cards stack of gained tricks
-                if (msg.score[player_id] > 0) {
-                    $('#cards_stack_img').attr('title', msg.score[player_id])
-                    $('#cards_stack').removeClass('d-none')
-                } else {
-                    $('#cards_stack').addClass('d-none')
-                }
-                // highlight current player for spectators view
-                if (!is_normal_player()) {
-                    // indicate current player in spectator overview
-                    $('.spectator-player').removeClass('spectator-current-player')
-                    if (!msg.is_last_turn) {
-                        $('#spectator_player_' + msg.current_player_id).addClass('spectator-current-player')
-                    }
-                }
+                // trick won by rules comes only after server let everybody see it for TRICK_DELAY seconds
+                show_next_trick(msg)
             }
         })
 
@@ -574,14 +672,11 @@ $(document).ready(function () {
         })
 
         // update either list of tables or users after a change
+        // lobby list comes already rendered
         socket.on('index-list-changed', function (msg) {
             if (!location.pathname.startsWith('/table/')) {
-                $.getJSON('/get/' + msg.table,
-                    function (data, status) {
-                        if (status == 'success') {
-                            $('#list_' + msg.table).html(data.html)
-                        }
-                    })
+                $('#list_' + msg.table).html(msg.html)
+                enable_locked_tables()
             }
         })
 
@@ -732,6 +827,23 @@ $(document).ready(function () {
             }
         })
 
+        // let server check cards and give tricks to their winners
+        $(document).on('click', '#switch_use_rules', function () {
+            if (this.checked) {
+                socket.emit('setup-table-change', {
+                    action: 'enable_rules',
+                    player_id: player_id,
+                    table_id: $(this).data('table_id')
+                })
+            } else {
+                socket.emit('setup-table-change', {
+                    action: 'disable_rules',
+                    player_id: player_id,
+                    table_id: $(this).data('table_id')
+                })
+            }
+        })
+
         // allow undoing a trick when wrong card was played
         $(document).on('click', '#switch_allow_undo', function () {
             if (this.checked) {
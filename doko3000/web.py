@@ -1,4 +1,6 @@
+from atexit import register
 from time import time
+from types import SimpleNamespace
 
 from flask import flash, \
     Flask, \
@@ -15,17 +17,27 @@ from flask_login import current_user, \
     logout_user
 from flask_socketio import join_room, \
     SocketIO
+from markupsafe import escape, \
+    Markup
 
 from .config import Config
-from .database import DB
+from .database import check_cooperative_io, \
+    DB, \
+    StorageUnavailable
 from .game import Deck, \
-    Game
+    Game, \
+    Rules
 from .misc import get_hash, \
     is_xhr, \
     MESSAGE_LOGIN_FAILURE
 
 # needed for ajax detection
 ACCEPTED_JSON_MIMETYPES = ['*/*', 'text/javascript', 'application/json']
+# version of state deltas doko3000.js has to understand - clients with another one reload
+PROTOCOL_VERSION = 2
+# socket.io rooms of clients showing the lobby - only admins see the list of players
+LOBBY_ROOMS = {'tables': 'lobby',
+               'players': 'lobby-admins'}
 
 # initialize app
 app = Flask(__name__)
@@ -51,14 +63,205 @@ socketio = SocketIO(app,
                     ping_interval=1,
                     logger=Config.DEBUG,
                     engineio_logger=Config.DEBUG,
-                    cors_allowed_origins=Config.CORS_ALLOWED_ORIGINS)
+                    cors_allowed_origins=Config.CORS_ALLOWED_ORIGINS,
+                    message_queue=Config.MESSAGE_QUEUE)
+
+# waiting for storage must not block every table
+check_cooperative_io(socketio.async_mode, blocking_detection=app.config['BLOCKING_DETECTION'])
+
+# changes made by other processes while loading have to be followed too, so remember where to start
+if app.config['CHANGES_FEED'] and db.backend.changes_feed:
+    changes_since = db.backend.update_seq()
+else:
+    changes_since = None
 
 # load game data from database after initialization
-game = Game(db)
+game = Game(db,
+            table_idle_timeout=app.config['TABLE_IDLE_TIMEOUT'],
+            snapshot_path=app.config['SNAPSHOT_PATH'],
+            version=app.config['VERSION'])
+
+
+def reload_conflicting_tables(changes):
+    """
+    stored documents replaced local ones after a conflict, but clients already got the local state
+    so clients at the tables concerned reload them
+    """
+    game.apply_changes(changes)
+    table_ids = set()
+    for change in changes:
+        document_type, _, item_id = change['id'].partition('-')
+        if document_type == 'table':
+            table_ids.add(change['id'])
+        elif document_type == 'round':
+            table_ids.add(item_id)
+        elif document_type == 'trick':
+            table_ids.add(item_id.rpartition('-')[0])
+        elif document_type == 'player' and \
+                change['id'] in game.player_tables:
+            table_ids.add(game.player_tables[change['id']])
+    for table_id in table_ids:
+        if table_id in game.tables:
+            socketio.emit('redirect-to-path',
+                          {'path': f'/table/{table_id}'},
+                          to=table_id)
+
+
+db.conflict_handler = reload_conflicting_tables
+
+# write-behind mode needs a background task writing journaled documents to CouchDB
+if db.write_behind:
+    socketio.start_background_task(db.write_behind.run, socketio.sleep)
+
+# documents queued while storage was unreachable get written when it is back
+socketio.start_background_task(db.run, socketio.sleep)
+
+# check now and then if storage needs compaction
+if db.maintenance:
+    socketio.start_background_task(db.maintenance.run, socketio.sleep)
 
 # keep track of players and their sessions to enable directly emitting a socketio event
 sessions = {}
 
+# how often rendered fragments of tables could be used again
+fragment_counts = {'hits': 0, 'misses': 0}
+
+# lists in lobby changed since their last push
+lobby_changes = set()
+
+
+def lobby_changed(*lists):
+    """
+    collect changed lists of lobby - bursts of changes get pushed together after a short while
+    """
+    if not lobby_changes:
+        socketio.start_background_task(push_lobby)
+    lobby_changes.update(lists)
+
+
+def push_lobby():
+    """
+    background task rendering every changed list of lobby only once for all clients in lobby
+    """
+    socketio.sleep(app.config['LOBBY_DEBOUNCE'])
+    with app.app_context():
+        while lobby_changes:
+            list_name = lobby_changes.pop()
+            socketio.emit('index-list-changed',
+                          {'table': list_name,
+                           'html': render_lobby_list(list_name)},
+                          to=LOBBY_ROOMS[list_name])
+
+
+def render_lobby_list(list_name):
+    """
+    HTML list of tables or players - the same for every player
+    """
+    if list_name == 'tables':
+        tables = sorted(game.tables.values(), key=lambda x: x.name.lower())
+        return render_template('index/list_tables.html',
+                               tables=tables,
+                               game=game)
+    else:
+        players = sorted(game.players.values(), key=lambda x: x.name.lower())
+        return render_template('index/list_players.html',
+                               players=players)
+
+
+def compile_card_fragments():
+    """
+    render cards/card.html once for every card of the deck with placeholders for table, timestamp and player
+    spectator hands and cards played by somebody differ a bit so there are 4 fragments per card
+    """
+    # null bytes are neither escaped nor expected in any card markup
+    placeholders = {x: f'\x00{x}\x00' for x in ['table_id', 'cards_timestamp', 'player_name']}
+    table = SimpleNamespace(id=placeholders['table_id'],
+                            round=SimpleNamespace(cards_timestamp=placeholders['cards_timestamp']))
+    players = {placeholders['player_name']: SimpleNamespace(name=placeholders['player_name'])}
+    game_stub = SimpleNamespace(players=players,
+                                deck=SimpleNamespace(file_extension=game.deck.file_extension))
+    template = app.jinja_env.get_template('cards/card.html')
+    card_fragments = {}
+    for card in Deck.cards.values():
+        for played_by in [False, True]:
+            for hand_spectator in [False, True]:
+                html = template.render(card=card,
+                                       table=table,
+                                       game=game_stub,
+                                       played_by=placeholders['player_name'] if played_by else None,
+                                       hand_spectator=hand_spectator)
+                # braces in markup must survive str.format()
+                html = html.replace('{', '{{').replace('}', '}}')
+                for name, placeholder in placeholders.items():
+                    html = html.replace(placeholder, f'{{{name}}}')
+                card_fragments[(card.id, played_by, hand_spectator)] = html
+    return card_fragments
+
+
+def render_card(card, table, played_by=None, hand_spectator=False):
+    """
+    fill in precompiled card fragment - used by templates instead of including cards/card.html for every card
+    """
+    if played_by:
+        player_name = escape(game.players[played_by].name)
+    else:
+        player_name = ''
+    return Markup(card_fragments[(card.id, bool(played_by), hand_spectator)].format(
+        table_id=escape(table.id),
+        cards_timestamp=table.round.cards_timestamp,
+        player_name=player_name))
+
+
+# card markup only depends on a few values which get filled in later
+card_fragments = compile_card_fragments()
+app.jinja_env.globals.update(render_card=render_card)
+
+
+def evict_idle_tables():
+    """
+    background task dropping rounds of idle tables from memory
+    """
+    while True:
+        # no need to check more often than a fraction of the timeout
+        socketio.sleep(min(60, game.table_idle_timeout))
+        game.evict_idle_rounds(players_connected=set(sessions))
+
+
+if game.table_idle_timeout:
+    socketio.start_background_task(evict_idle_tables)
+
+
+def follow_changes(since):
+    """
+    background task applying changes of other processes sharing the same database
+    """
+    while True:
+        socketio.sleep(app.config['CHANGES_INTERVAL'])
+        changes, since = db.changes(since)
+        if changes:
+            # objects rebuilt from changes might save something too
+            with db.unit_of_work():
+                game.apply_changes(changes)
+
+
+if changes_since is not None:
+    socketio.start_background_task(follow_changes, changes_since)
+
+
+def save_snapshots():
+    """
+    background task saving snapshots periodically
+    """
+    while True:
+        socketio.sleep(app.config['SNAPSHOT_INTERVAL'])
+        game.save_snapshot()
+
+
+if game.snapshot_path:
+    socketio.start_background_task(save_snapshots)
+    # graceful shutdown leaves the newest snapshot
+    register(game.save_snapshot)
+
 
 @login.user_loader
 def load_user(id):
@@ -72,6 +275,25 @@ def load_user(id):
         return None
 
 
+@app.errorhandler(StorageUnavailable)
+def storage_unavailable(error):
+    """
+    something not in memory could not be loaded - client may try again later
+    """
+    return jsonify({'status': 'storage unavailable'}), 503
+
+
+@socketio.on_error_default
+def socket_error(error):
+    """
+    events needing something not in memory just fail while storage is unreachable, other errors stay loud
+    """
+    if isinstance(error, StorageUnavailable):
+        print('ERROR', request.event['message'], 'storage unavailable')
+    else:
+        raise error
+
+
 # no decorator possible for socketio.on-events so make this a function
 def check_message(msg, player_in_round=True, player_at_table=True):
     """
@@ -112,7 +334,31 @@ def check_message(msg, player_in_round=True, player_at_table=True):
 #
 # ------------ Socket.io events ------------
 #
+@socketio.on('disconnect')
+def disconnect(*args):
+    """
+    forget session of player to know it is not connected anymore
+    """
+    for player_id, sid in list(sessions.items()):
+        if sid == request.sid:
+            sessions.pop(player_id)
+
+
+@socketio.on('enter-lobby')
+def enter_lobby():
+    """
+    sent by clients showing the lobby to get its lists pushed when they change
+    """
+    if not current_user.is_anonymous:
+        player = game.players.get(current_user.id)
+        if player:
+            join_room(LOBBY_ROOMS['tables'])
+            if player.is_admin:
+                join_room(LOBBY_ROOMS['players'])
+
+
 @socketio.on('who-am-i')
+@db.unit_of_work()
 def who_am_i():
     """
     sent by client at connection creation and if connection was refreshed
@@ -156,6 +402,7 @@ def who_am_i():
 
 
 @socketio.on('enter-table')
+@db.unit_of_work()
 def enter_table_socket(msg):
     """
     sent if player wants to enter a table - allowed if table is not locked
@@ -173,22 +420,19 @@ def enter_table_socket(msg):
             join_room(table.id)
             # check if any formerly locked table is now emtpy and should be unlocked
             game.check_tables()
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
             # send message to old table and new one to update HUD on old table too
             for target_table in [table_old, table]:
                 if target_table:
                     socketio.emit('hud-changed',
-                                  {'html': {'hud_players': render_template('top/hud_players.html',
-                                                                           table=target_table,
-                                                                           player=player,
-                                                                           game=game)
+                                  {'html': {'hud_players': render_fragment(target_table, 'top/hud_players.html')
                                             }},
                                   to=target_table.id
                                   )
 
 
 @socketio.on('card-played')
+@db.unit_of_work()
 def played_card(msg):
     """
     sent when a player played a card, update table and tell all other clients
@@ -198,54 +442,65 @@ def played_card(msg):
         card_id = msg.get('card_id')
         # check if cards on hand are correct
         cards_hand_ids = msg.get('cards_hand_ids')
-        if set(cards_hand_ids) | {card_id} == set(player.cards) and \
-                len(cards_hand_ids) + 1 == len(player.cards):
-            if card_id in Deck.cards and \
-                    len(table.round.current_trick.cards) < 4 and \
+        if player.has_cards(cards_hand_ids + [card_id]):
+            # cards played out of turn are ignored before even looking at them
+            if len(table.round.current_trick.cards) < 4 and \
                     current_user.id == player.id == table.round.current_player_id:
-                table.round.current_trick.add_turn(player.id, card_id)
-                table.round.increase_turn_count()
-                card = Deck.cards[card_id]
-                player.remove_card(card.id)
-                current_player_id = table.round.get_current_player_id()
-                if table.round.player_showing_hand:
-                    # player_showing_hand contains cards-showing player_id
-                    cards_table = game.players[table.round.player_showing_hand].get_cards()
+                if table.round.use_rules and \
+                        not Rules.is_legal(card_id, player.get_cards_mask(), table.round.current_trick.cards):
+                    # card does not follow suit - player gets it back
+                    deliver_cards_to_player(msg)
                 else:
-                    cards_table = table.round.current_trick.get_cards()
-                table.increase_sync_count()
-                event = 'card-played-by-player'
-                payload = {'player_id': player.id,
-                           'table_id': table.id,
-                           'card_id': card.id,
-                           'card_name': card.name,
-                           'is_last_turn': table.round.current_trick.is_last_turn,
-                           'current_player_id': current_player_id,
-                           'players_idle': table.players_idle,
-                           'players_spectator_only': table.players_spectator_only,
-                           'played_cards': table.round.played_cards,
-                           'player_showing_hand': table.round.player_showing_hand,
-                           'sync_count': table.sync_count,
-                           'html': {'cards_table': render_template('cards/table.html',
-                                                                   cards_table=cards_table,
-                                                                   table=table,
-                                                                   game=game),
-                                    'hud_players': render_template('top/hud_players.html',
-                                                                   table=table,
-                                                                   player=player,
-                                                                   game=game)
-                                    }}
-                room = table.id
-                # debugging...
-                if table.is_debugging:
-                    table.log(event, payload, room)
-                # ...and action
-                socketio.emit(event, payload, to=room)
+                    table.round.add_turn(player.id, card_id)
+                    table.round.increase_turn_count()
+                    card = Deck.cards[card_id]
+                    player.remove_card(card.id)
+                    current_player_id = table.round.get_current_player_id()
+                    table.increase_sync_count()
+                    event = 'card-played-by-player'
+                    payload = {'player_id': player.id,
+                               'table_id': table.id,
+                               'card_id': card.id,
+                               'card_name': card.name,
+                               'is_last_turn': table.round.current_trick.is_last_turn,
+                               'current_player_id': current_player_id,
+                               'players_idle': table.players_idle,
+                               'players_spectator_only': table.players_spectator_only,
+                               'player_showing_hand': table.round.player_showing_hand,
+                               'use_rules': table.round.use_rules,
+                               'sync_count': table.sync_count}
+                    if app.config['STATE_DELTAS'] and \
+                            not table.round.player_showing_hand:
+                        # clients add the card to the table themselves
+                        payload.update({'protocol': PROTOCOL_VERSION,
+                                        'player_name': player.name})
+                    else:
+                        if table.round.player_showing_hand:
+                            # player_showing_hand contains cards-showing player_id
+                            cards_table = game.players[table.round.player_showing_hand].get_cards()
+                        else:
+                            cards_table = table.round.current_trick.get_cards()
+                        payload.update({'played_cards': table.round.played_cards,
+                                        'html': {'cards_table': render_fragment(table, 'cards/table.html',
+                                                                                 cards_table=cards_table),
+                                                 'hud_players': render_fragment(table, 'top/hud_players.html')
+                                                 }})
+                    room = table.id
+                    # debugging...
+                    if table.is_debugging:
+                        table.log(event, payload, room)
+                    # ...and action
+                    socketio.emit(event, payload, to=room)
+                    # with rules the trick goes to its winner without waiting for a claim
+                    if table.round.use_rules and \
+                            table.round.current_trick.is_last_turn:
+                        socketio.start_background_task(give_trick_to_winner, table.id, table.sync_count)
         else:
             deliver_cards_to_player(msg)
 
 
 @socketio.on('card-exchanged')
+@db.unit_of_work()
 def card_exchanged(msg):
     """
     sent if re/contra exchange succeeded
@@ -261,6 +516,7 @@ def card_exchanged(msg):
 
 
 @socketio.on('exchange-player-cards-to-server')
+@db.unit_of_work()
 def exchange_player_cards(msg):
     """
     both stages of card exchange fire this message up, each transmitting its exchanged cards
@@ -271,12 +527,14 @@ def exchange_player_cards(msg):
         if table.round.exchange and \
                 table.round.exchange.get(exchange_hash):
             exchange = table.round.exchange[exchange_hash]
-            if set(msg.get('cards_table_ids')) == set(exchange[player.id]):
+            if Deck.is_same_cards(msg.get('cards_table_ids'), exchange[player.id]):
                 # remove cards from exchanging player
                 player.remove_cards(exchange[player.id])
                 # get peer id to send cards to
                 peer = game.players[player.exchange_peer_id]
                 peer.cards += exchange[player.id]
+                # spectators see the hands changed without sync count increased
+                table.forget_fragments()
                 cards_hand = [Deck.cards[x] for x in peer.cards]
                 cards_exchange_count = len(exchange[player.id])
                 # if peer has no cards yet put onto table exchange is still in exchange mode
@@ -317,6 +575,7 @@ def exchange_player_cards(msg):
 
 
 @socketio.on('setup-table-change')
+@db.unit_of_work()
 def setup_table(msg):
     """
     table can be set up from lobby so it makes no sense to limit setup by using check_message()
@@ -329,22 +588,23 @@ def setup_table(msg):
         if action == 'remove_player':
             table.remove_player(player.id)
             # tell others about table change
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
         elif action == 'lock_table':
             table.locked = True
             # tell others about table change
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
         elif action == 'unlock_table':
             table.locked = False
             # tell others about table change
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
         elif action == 'play_with_9':
             table.round.with_9 = True
         elif action == 'play_without_9':
             table.round.with_9 = False
+        elif action == 'enable_rules':
+            table.round.use_rules = True
+        elif action == 'disable_rules':
+            table.round.use_rules = False
         elif action == 'allow_undo':
             table.round.allow_undo = True
         elif action == 'prohibit_undo':
@@ -371,27 +631,23 @@ def setup_table(msg):
                               {'path': f'/table/{table.id}'},
                               to=request.sid)
             else:
-                # just tell everybody to get personal cards
+                # just give everybody personal cards
                 # for unknown reason this does not seem to be necessary because the connection
                 # gets lost in every case and client just tries to reconnect
-                socketio.emit('grab-your-cards',
-                              {'table_id': table.id,
-                               'sync_count': table.sync_count},
-                              to=table.id)
+                push_cards(table)
         # tell others about table change
         elif action == 'finished':
             # tell others about table change
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
     # new tables do not have an id, so check_msg would fail
     # only of interest on index page
     elif player and action == 'finished':
         # tell others about table change
-        socketio.emit('index-list-changed',
-                      {'table': 'tables'})
+        lobby_changed('tables')
 
 
 @socketio.on('setup-player-change')
+@db.unit_of_work()
 def setup_player(msg):
     """
     player settings might be set from admin too, so there is no check if current_user.id == player.id
@@ -424,14 +680,13 @@ def setup_player(msg):
                               to=request.sid)
         elif action == 'finished':
             # tell others about player change
-            socketio.emit('index-list-changed',
-                          {'table': 'players'})
+            lobby_changed('players')
             # list of tables could use an update too in e.g. case player became spectator only
-            socketio.emit('index-list-changed',
-                          {'table': 'tables'})
+            lobby_changed('tables')
 
 
 @socketio.on('deal-cards')
+@db.unit_of_work()
 def deal_cards(msg):
     """
     dealer triggers distribution of cards to players
@@ -440,21 +695,12 @@ def deal_cards(msg):
     if msg_ok:
         # table increases its sync_count when resetting round
         table.reset_round()
-        # just tell everybody to get personal cards
-        event = 'grab-your-cards'
-        payload = {'table_id': table.id,
-                   'sync_count': table.sync_count}
-        room = table.id
-        # debugging...
-        if table.is_debugging:
-            table.log(event, payload, room)
-        # ...and action
-        socketio.emit(event,
-                      payload,
-                      to=room)
+        # just give everybody personal cards
+        push_cards(table)
 
 
 @socketio.on('deal-cards-again')
+@db.unit_of_work()
 def deal_cards_again(msg):
     """
     current dealer pressed the deal-again-button
@@ -471,100 +717,155 @@ def deal_cards_again(msg):
 
 
 @socketio.on('my-cards-please')
+@db.unit_of_work()
 def deliver_cards_to_player(msg):
     """
     give player cards after requesting them
+    normally cards get pushed by push_cards() - requesting them is needed if client lost sync
     """
     msg_ok, player, table = check_message(msg, player_in_round=False)
     if msg_ok:
         # just in case
         join_room(table.id)
-        exchange_needed = table.round.is_exchange_needed(player.id)
         if player.id in table.round.players and \
                 player.id in table.players_active:
-            cards_hand = player.get_cards()
-            if table.round.player_showing_hand:
-                # player_showing_hand contains cards-showing player_id
-                cards_table = game.players[table.round.player_showing_hand].get_cards()
-            elif exchange_needed:
-                exchange_hash = get_hash(player.id, player.exchange_peer_id)
-                cards_table = game.deck.get_cards(table.round.exchange[exchange_hash][player.id])
-                # take out the cards from player's hand which lay on table
-                cards_hand = [x for x in cards_hand if x.id not in table.round.exchange[exchange_hash][player.id]]
-            else:
-                cards_table = []
-            mode = 'player'
-            # putting into variables makes debugging easier
             event = 'your-cards-please'
-            payload = {'player_id': player.id,
-                       'table_id': table.id,
-                       'turn_count': table.round.turn_count,
-                       'current_player_id': table.round.current_player_id,
-                       'dealer': table.dealer,
-                       'needs_dealing': table.round.needs_dealing,
-                       'needs_trick_claiming': table.round.needs_trick_claiming,
-                       'exchange_needed': exchange_needed,
-                       'player_showing_hand': table.round.player_showing_hand,
-                       'sync_count': table.sync_count,
-                       'cards_per_player': table.round.cards_per_player,
-                       'html': {'cards_hand': render_template('cards/hand.html',
-                                                              cards_hand=cards_hand,
-                                                              table=table,
-                                                              player=player,
-                                                              game=game),
-                                'hud_players': render_template('top/hud_players.html',
-                                                               table=table,
-                                                               player=player,
-                                                               game=game),
-                                'cards_table': render_template('cards/table.html',
-                                                               cards_table=cards_table,
-                                                               table=table,
-                                                               game=game,
-                                                               mode=mode)}
-                       }
-            room = request.sid
-            # debugging...
-            if table.is_debugging:
-                table.log(event, payload, room)
-            # ...and action
-            socketio.emit(event, payload, to=room)
+            payload = get_player_cards_payload(player, table)
         elif not table.needs_welcome:
             # spectator mode
-            players_cards = table.round.get_players_shuffled_cards()
-            if table.round.player_showing_hand:
-                # player_showing_hand contains cards-showing player_id
-                cards_table = game.players[table.round.player_showing_hand].get_cards()
-            else:
-                cards_table = table.round.current_trick.get_cards()
-            mode = 'spectator'
             event = 'sorry-no-cards-for-you'
-            payload = {'sync_count': table.sync_count,
-                       'html': {'hud_players': render_template('top/hud_players.html',
-                                                               table=table,
-                                                               player=player,
-                                                               game=game),
-                                'cards_table': render_template('cards/table.html',
-                                                               cards_table=cards_table,
-                                                               table=table,
-                                                               mode=mode),
-                                'cards_hand_spectator_upper': render_template('cards/hand_spectator_upper.html',
-                                                                              table=table,
-                                                                              players_cards=players_cards,
-                                                                              game=game),
-                                'cards_hand_spectator_lower': render_template('cards/hand_spectator_lower.html',
-                                                                              table=table,
-                                                                              players_cards=players_cards,
-                                                                              game=game)
-                                }}
-            room = request.sid
-            # debugging...
-            if table.is_debugging:
-                table.log(event, payload, room)
-            # ...and action
-            socketio.emit(event, payload, to=room)
+            payload = get_spectator_cards_payload(table)
+        else:
+            return
+        room = request.sid
+        # debugging...
+        if table.is_debugging:
+            table.log(event, payload, room)
+        # ...and action
+        socketio.emit(event, payload, to=room)
+
+
+def push_cards(table):
+    """
+    send every connected player at table its cards right after dealing instead of letting all of them ask for
+    their cards at once - spectators all get the same view
+    """
+    spectator_payload = None
+    for player_id in table.players:
+        room = sessions.get(player_id)
+        if not room:
+            # player will ask when connecting again
+            continue
+        player = game.players[player_id]
+        # just in case
+        join_room(table.id, sid=room)
+        if player.id in table.round.players and \
+                player.id in table.players_active:
+            event = 'your-cards-please'
+            payload = get_player_cards_payload(player, table)
+        elif not table.needs_welcome:
+            # spectator mode
+            event = 'sorry-no-cards-for-you'
+            if spectator_payload is None:
+                spectator_payload = get_spectator_cards_payload(table)
+            payload = spectator_payload
+        else:
+            continue
+        # debugging...
+        if table.is_debugging:
+            table.log(event, payload, room)
+        # ...and action
+        socketio.emit(event, payload, to=room)
+
+
+def render_fragment(table, template, mode=None, **context):
+    """
+    render HUD, cards on table or spectator hands only once per state of table and share it by all its clients
+    tables forget their fragments when sync count increases or something else shown changes
+    """
+    key = (table.id, table.sync_count, template, mode)
+    if key in table.fragments:
+        fragment_counts['hits'] += 1
+    else:
+        fragment_counts['misses'] += 1
+        table.fragments[key] = render_template(template,
+                                               table=table,
+                                               game=game,
+                                               mode=mode,
+                                               **context)
+    return table.fragments[key]
+
+
+def get_player_cards_payload(player, table):
+    """
+    cards on hand and table as seen by player in current round
+    """
+    exchange_needed = table.round.is_exchange_needed(player.id)
+    cards_hand = player.get_cards()
+    if table.round.player_showing_hand:
+        # player_showing_hand contains cards-showing player_id
+        cards_table = game.players[table.round.player_showing_hand].get_cards()
+    elif exchange_needed:
+        exchange_hash = get_hash(player.id, player.exchange_peer_id)
+        cards_table = game.deck.get_cards(table.round.exchange[exchange_hash][player.id])
+        # take out the cards from player's hand which lay on table
+        cards_hand = [x for x in cards_hand if x.id not in table.round.exchange[exchange_hash][player.id]]
+    else:
+        cards_table = []
+    mode = 'player'
+    if exchange_needed:
+        # exchanged cards are only seen by player and change without increasing sync count
+        html_cards_table = render_template('cards/table.html',
+                                           cards_table=cards_table,
+                                           table=table,
+                                           game=game,
+                                           mode=mode)
+    else:
+        html_cards_table = render_fragment(table, 'cards/table.html', mode, cards_table=cards_table)
+    return {'player_id': player.id,
+            'table_id': table.id,
+            'turn_count': table.round.turn_count,
+            'current_player_id': table.round.current_player_id,
+            'dealer': table.dealer,
+            'needs_dealing': table.round.needs_dealing,
+            'needs_trick_claiming': table.round.needs_trick_claiming,
+            'exchange_needed': exchange_needed,
+            'player_showing_hand': table.round.player_showing_hand,
+            'sync_count': table.sync_count,
+            'cards_per_player': table.round.cards_per_player,
+            'html': {'cards_hand': render_template('cards/hand.html',
+                                                   cards_hand=cards_hand,
+                                                   table=table,
+                                                   player=player,
+                                                   game=game),
+                     'hud_players': render_fragment(table, 'top/hud_players.html'),
+                     'cards_table': html_cards_table}
+            }
+
+
+def get_spectator_cards_payload(table):
+    """
+    cards of all players as far as they allow spectators and cards on table
+    """
+    players_cards = table.round.get_players_shuffled_cards()
+    if table.round.player_showing_hand:
+        # player_showing_hand contains cards-showing player_id
+        cards_table = game.players[table.round.player_showing_hand].get_cards()
+    else:
+        cards_table = table.round.current_trick.get_cards()
+    mode = 'spectator'
+    return {'sync_count': table.sync_count,
+            'html': {'hud_players': render_fragment(table, 'top/hud_players.html'),
+                     'cards_table': render_fragment(table, 'cards/table.html', mode, cards_table=cards_table),
+                     'cards_hand_spectator_upper': render_fragment(table, 'cards/hand_spectator_upper.html', mode,
+                                                                   players_cards=players_cards),
+                     'cards_hand_spectator_lower': render_fragment(table, 'cards/hand_spectator_lower.html', mode,
+                                                                   players_cards=players_cards)
+                     }}
 
 
 @socketio.on('sorted-cards')
+@db.unit_of_work()
 def sorted_cards(msg):
     """
     while player sorts cards every card placed somewhere causes transmission of current card sort order
@@ -574,8 +875,7 @@ def sorted_cards(msg):
     if msg_ok:
         cards_hand_ids = msg.get('cards_hand_ids')
         # send player its real cards back if cards on client don't match the ones on server
-        if set(cards_hand_ids) == set(player.cards) and \
-                len(cards_hand_ids) == len(player.cards):
+        if player.has_cards(cards_hand_ids):
             player.cards = cards_hand_ids
             player.save()
         else:
@@ -583,57 +883,80 @@ def sorted_cards(msg):
 
 
 @socketio.on('claim-trick')
+@db.unit_of_work()
 def claim_trick(msg):
     """
     when all players played their cards someone will claim the trick
     """
     msg_ok, player, table = check_message(msg)
-    if msg_ok:
-        table.increase_sync_count()
-        if not table.round.is_finished:
-            # when ownership changes it does at previous trick because normally there is a new one created
-            # so the new one becomes the current one and the reclaimed is the previous
-            if not len(table.round.current_trick.cards) == 0:
-                # makes player owner of trick
-                table.round.take_trick(player.id)
-            else:
-                # apparently the ownership of the previous trick is not clear - change it
-                table.round.previous_trick.owner = player.id
-                table.round.current_player_id = player.id
-            cards_table = []
-            table.round.calculate_trick_order()
-            table.round.calculate_stats()
-
-            socketio.emit('next-trick',
-                          {'current_player_id': player.id,
-                           'score': table.round.stats['score'],
-                           'table_id': table.id,
-                           'sync_count': table.sync_count,
-                           'html': {'hud_players': render_template('top/hud_players.html',
-                                                                   table=table,
-                                                                   player=player,
-                                                                   game=game),
-                                    'cards_table': render_template('cards/table.html',
-                                                                   cards_table=cards_table,
-                                                                   table=table)
-                                    }},
-                          to=table.id)
+    # with rules the trick already went to its winner
+    if msg_ok and \
+            not table.round.use_rules:
+        take_trick(table, player)
+
+
+def give_trick_to_winner(table_id, sync_count):
+    """
+    background task giving complete trick to its winner by rules after everybody had the time to see it
+    """
+    socketio.sleep(app.config['TRICK_DELAY'])
+    with app.app_context(), db.unit_of_work():
+        table = game.tables.get(table_id)
+        # table moved on meanwhile, e.g. by undo or a new round
+        if table and \
+                table.sync_count == sync_count and \
+                table.round.current_trick.is_last_turn:
+            take_trick(table, game.players[Rules.get_winner(table.round.current_trick)])
+
+
+def take_trick(table, player):
+    """
+    give trick to player and tell everybody - either claimed by player or won by rules
+    """
+    table.increase_sync_count()
+    if not table.round.is_finished:
+        # when ownership changes it does at previous trick because normally there is a new one created
+        # so the new one becomes the current one and the reclaimed is the previous
+        if not len(table.round.current_trick.cards) == 0:
+            # makes player owner of trick
+            table.round.take_trick(player.id)
         else:
-            table.round.current_trick.owner = player.id
-            table.round.calculate_stats()
-            table.shift_players()
-            # tell everybody stats and wait for everybody confirming next round
-            socketio.emit('round-finished',
-                          {'table_id': table.id,
-                           'sync_count': table.sync_count,
-                           'html': render_template('round/score.html',
-                                                   table=table,
-                                                   game=game)
-                           },
-                          to=table.id)
+            # apparently the ownership of the previous trick is not clear - change it
+            table.round.set_trick_owner(table.round.trick_count, player.id)
+            table.round.current_player_id = player.id
+        table.round.calculate_trick_order()
+        payload = {'current_player_id': player.id,
+                   'score': table.round.stats['score'],
+                   'table_id': table.id,
+                   'use_rules': table.round.use_rules,
+                   'sync_count': table.sync_count}
+        if app.config['STATE_DELTAS']:
+            # clients clear the table and rearrange their HUD themselves
+            payload.update({'protocol': PROTOCOL_VERSION,
+                            'trick_order': table.round.trick_order,
+                            'tricks': table.round.stats['tricks']})
+        else:
+            payload['html'] = {'hud_players': render_fragment(table, 'top/hud_players.html'),
+                               'cards_table': render_fragment(table, 'cards/table.html', cards_table=[])
+                               }
+        socketio.emit('next-trick', payload, to=table.id)
+    else:
+        # last trick of round
+        table.round.take_trick(player.id)
+        table.shift_players()
+        # tell everybody stats and wait for everybody confirming next round
+        socketio.emit('round-finished',
+                      {'table_id': table.id,
+                       'sync_count': table.sync_count,
+                       'html': render_template('round/score.html',
+                                               table=table,
+                                               game=game)
+                       },
+                      to=table.id)
 
 
 @socketio.on('need-final-result')
+@db.unit_of_work()
 def need_final_result(msg):
     """
     at the end of the round the resulting score will be shown to the players
@@ -652,6 +975,7 @@ def need_final_result(msg):
 
 
 @socketio.on('ready-for-next-round')
+@db.unit_of_work()
 def ready_for_next_round(msg):
     """
     every player commits being ready for the next round
@@ -679,6 +1003,7 @@ def ready_for_next_round(msg):
 
 
 @socketio.on('ready-for-next-round-and-read-info')
+@db.unit_of_work()
 def round_reset(msg):
     """
     players confirm restarting the round
@@ -692,6 +1017,7 @@ def round_reset(msg):
 
 
 @socketio.on('request-round-finish')
+@db.unit_of_work()
 def request_round_finish(msg):
     """
     players want to skip and finish the round
@@ -710,6 +1036,7 @@ def request_round_finish(msg):
 
 
 @socketio.on('ready-for-round-finish')
+@db.unit_of_work()
 def round_finish(msg):
     """
     players confirm to finish the round
@@ -739,6 +1066,7 @@ def round_finish(msg):
 
 
 @socketio.on('request-round-reset')
+@db.unit_of_work()
 def request_round_reset(msg):
     """
     round shall be restarted
@@ -757,6 +1085,7 @@ def request_round_reset(msg):
 
 
 @socketio.on('ready-for-round-reset')
+@db.unit_of_work()
 def round_reset(msg):
     """
     players confirm restarting the round
@@ -770,13 +1099,11 @@ def round_reset(msg):
                        'player_ready_id': player.id})
         if set(table.players_ready) >= set(table.round.players):
             table.reset_round()
-            socketio.emit('grab-your-cards',
-                          {'table_id': table.id,
-                           'sync_count': table.sync_count},
-                          to=table.id)
+            push_cards(table)
 
 
 @socketio.on('request-undo')
+@db.unit_of_work()
 def request_undo(msg):
     """
     players request reverting the last trick
@@ -797,6 +1124,7 @@ def request_undo(msg):
 
 
 @socketio.on('ready-for-undo')
+@db.unit_of_work()
 def round_undo(msg):
     """
     players confirm reverting the last trick
@@ -810,12 +1138,13 @@ def round_undo(msg):
                        'player_ready_id': player.id})
         if set(table.players_ready) >= set(table.round.players):
             table.round.undo()
-            socketio.emit('grab-your-cards',
-                          {'table_id': table.id},
-                          to=table.id)
+            # undo does not increase sync count
+            table.forget_fragments()
+            push_cards(table)
 
 
 @socketio.on('request-show-hand')
+@db.unit_of_work()
 def request_show_hand(msg):
     """
     player wants a shortcut and show the cards on hand
@@ -832,6 +1161,7 @@ def request_show_hand(msg):
 
 
 @socketio.on('show-hand')
+@db.unit_of_work()
 def show_hand(msg):
     """
     player shows cards
@@ -843,10 +1173,7 @@ def show_hand(msg):
         event = 'cards-shown-by-player'
         payload = {'table_id': table.id,
                    'sync_count': table.sync_count,
-                   'html': {'cards_table': render_template('cards/table.html',
-                                                           cards_table=cards_table,
-                                                           table=table,
-                                                           game=game)
+                   'html': {'cards_table': render_fragment(table, 'cards/table.html', cards_table=cards_table)
                             }}
         room = table.id
         # debugging...
@@ -857,6 +1184,7 @@ def show_hand(msg):
 
 
 @socketio.on('request-exchange')
+@db.unit_of_work()
 def request_exchange(msg):
     """
     player asks for exchange
@@ -883,6 +1211,7 @@ def request_exchange(msg):
 
 
 @socketio.on('exchange-start')
+@db.unit_of_work()
 def exchange_ask_player2(msg):
     """
     exchange peer player2 has to be asked
@@ -910,6 +1239,7 @@ def exchange_ask_player2(msg):
 
 
 @socketio.on('exchange-cancel-player1')
+@db.unit_of_work()
 def exchange_cancel(msg):
     """
     the initiating player 1 canceled the exchange - all other players need to know to get their tables unlocked
@@ -928,6 +1258,7 @@ def exchange_cancel(msg):
 
 
 @socketio.on('exchange-player2-ready')
+@db.unit_of_work()
 def exchange_player2_ready(msg):
     """
     exchange peer is willing and ready
@@ -954,6 +1285,7 @@ def exchange_player2_ready(msg):
 
 
 @socketio.on('exchange-player2-deny')
+@db.unit_of_work()
 def exchange_player2_deny(msg):
     """
     exchange peer doesn't want to exchange
@@ -1185,10 +1517,7 @@ def get_tables():
     get HTML list of tables to refresh index.html tables list after changes
     """
     if is_xhr(request):
-        tables = sorted(game.tables.values(), key=lambda x: x.name.lower())
-        return jsonify({'html': render_template('index/list_tables.html',
-                                                tables=tables,
-                                                game=game)})
+        return jsonify({'html': render_lobby_list('tables')})
     # default return if nothing applies
     return redirect(url_for('index'))
 
@@ -1200,9 +1529,7 @@ def get_players():
     get HTML list of players to refresh index.html players list after changes
     """
     if is_xhr(request):
-        players = sorted(game.players.values(), key=lambda x: x.name.lower())
-        return jsonify({'html': render_template('index/list_players.html',
-                                                players=players)})
+        return jsonify({'html': render_lobby_list('players')})
     # default return if nothing applies
     return redirect(url_for('index'))
 
@@ -1228,8 +1555,34 @@ def get_wait(table_id='', player_id=''):
     return redirect(url_for('index'))
 
 
+@app.route('/health')
+def health():
+    """
+    state of storage connection for monitoring - details are only for admins via /get/maintenance
+    """
+    return jsonify({'status': db.health()['status']})
+
+
+@app.route('/get/maintenance')
+@login_required
+def get_maintenance():
+    """
+    fragmentation of storage, history of compactions and counts of written versus skipped saves for admins
+    """
+    if current_user.is_admin:
+        status = {'saves': db.save_counts,
+                  'fragments': fragment_counts,
+                  'health': db.health()}
+        if db.maintenance:
+            status.update(db.maintenance.status())
+        return jsonify(status)
+    # default return if nothing applies
+    return redirect(url_for('index'))
+
+
 @app.route('/create/table', methods=['GET', 'POST'])
 @login_required
+@db.unit_of_work()
 def create_table():
     """
     create table via button
@@ -1255,6 +1608,7 @@ def create_table():
 
 @app.route('/create/player', methods=['GET', 'POST'])
 @login_required
+@db.unit_of_work()
 def create_player():
     """
     create table via button
@@ -1296,6 +1650,7 @@ def create_player():
 
 @app.route('/delete/player/<player_id>', methods=['GET', 'POST'])
 @login_required
+@db.unit_of_work()
 def delete_player(player_id):
     """
     delete player from players list on index page and thus from game at all
@@ -1323,6 +1678,7 @@ def delete_player(player_id):
 
 @app.route('/delete/table/<table_id>', methods=['GET', 'POST'])
 @login_required
+@db.unit_of_work()
 def delete_table(table_id):
     """
     delete table from players list on index page and thus from game at all
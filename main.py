@@ -5,6 +5,13 @@
 # Attempt to play good ol' Doppelkopf online
 #
 
+# storage I/O has to be cooperative to let other tables play while one waits for CouchDB
+# gunicorn's eventlet worker patches before it imports this module, so only a direct start needs patching here,
+# before doko3000 imports socket or threading
+if __name__ == '__main__':
+    import eventlet
+    eventlet.monkey_patch()
+
 from doko3000.web import app, \
     socketio
 
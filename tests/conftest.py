@@ -0,0 +1,133 @@
+# fixtures running doko3000 against the in-memory fake CouchDB
+#
+# every test gets its own database so tests do not see each other's documents
+
+from os import environ
+from uuid import uuid4
+
+from flask import Flask
+import pytest
+
+from doko3000.fake_couchdb import serve
+
+# one fake CouchDB for all tests, listening on a free port
+fake, server = serve(port=0)
+# doko3000.web reads its configuration from environment when imported
+environ['COUCHDB_URL'] = f'http://127.0.0.1:{server.server_port}'
+environ['COUCHDB_DATABASE'] = f'doko3000-web-{uuid4().hex}'
+environ['COMPACTION_INTERVAL'] = '0'
+
+from doko3000.config import Config
+from doko3000.database import DB
+from doko3000.game import Game
+
+
+@pytest.fixture
+def couchdb():
+    """
+    fake CouchDB, reachable again after every test
+    """
+    yield fake
+    fake.down = False
+    fake.latency = 0.0
+    fake.error_rate = 0.0
+
+
+@pytest.fixture
+def create_app(couchdb, tmp_path):
+    """
+    factory of Flask apps sharing one fresh database, e.g. for several processes
+    """
+    database = f'doko3000-{uuid4().hex}'
+
+    def create(**config):
+        app = Flask(__name__)
+        app.config.from_object(Config)
+        app.config.update(COUCHDB_DATABASE=database,
+                          STORAGE_RETRY_DELAY=0.01,
+                          WRITE_BEHIND_JOURNAL=str(tmp_path / 'doko3000.journal'))
+        app.config.update(config)
+        return app
+
+    return create
+
+
+@pytest.fixture
+def create_game(create_app):
+    """
+    factory of games with 4 players sitting at one started table
+    """
+    def create(**config):
+        game = Game(DB(create_app(**config)))
+        table = game.add_table('table')
+        for name in ['alice', 'bob', 'carol', 'dave']:
+            table.add_player(game.add_player(name=name, password=name).id)
+        table.start()
+        return game
+
+    return create
+
+
+@pytest.fixture
+def game(create_game):
+    """
+    game with 4 players sitting at one started table
+    """
+    return create_game()
+
+
+@pytest.fixture
+def web(couchdb):
+    """
+    web app of doko3000 as started by main.py, using the database of conftest
+    """
+    from doko3000 import web
+    web.app.config.update(TESTING=True,
+                          SESSION_COOKIE_SECURE=False,
+                          TRICK_DELAY=0.05)
+    sockets = []
+
+    def connect(name, path='/'):
+        """
+        log player in and connect its socket like a browser showing path
+        """
+        if not web.game.get_player(name):
+            web.game.add_player(name=name, password=name)
+        client = web.app.test_client()
+        client.post('/login', data={'name': name, 'password': name, 'submit': '1'})
+        socket = web.socketio.test_client(web.app,
+                                          flask_test_client=client,
+                                          headers={'Referer': f'http://localhost{path}'})
+        socket.emit('who-am-i')
+        sockets.append(socket)
+        return web.game.get_player(name), client, socket
+
+    web.connect = connect
+    yield web
+    for socket in sockets:
+        if socket.is_connected():
+            socket.disconnect()
+
+
+@pytest.fixture
+def seated(web):
+    """
+    factory of tables with 4 players sitting there, connected by socket
+    """
+    def seat(rules=False, start=True):
+        table = web.game.add_table(f'table-{uuid4().hex[:8]}')
+        sockets = {}
+        for name in ['alice', 'bob', 'carol', 'dave']:
+            player, _, socket = web.connect(name, f'/table/{table.id}')
+            socket.emit('enter-table', {'player_id': player.id, 'table_id': table.id})
+            sockets[player.id] = socket
+        socket = sockets[table.players[0]]
+        if rules:
+            socket.emit('setup-table-change', {'action': 'enable_rules', 'player_id': table.players[0], 'table_id': table.id})
+        if start:
+            socket.emit('setup-table-change', {'action': 'start_table', 'player_id': table.players[0], 'table_id': table.id})
+        for socket in sockets.values():
+            socket.get_received()
+        return table, sockets
+
+    return seat
@@ -0,0 +1,62 @@
+from doko3000.database import DB
+from doko3000.game import Game
+
+
+def follow(game, since):
+    """
+    apply changes of other processes like the background task does
+    """
+    changes, since = game.db.changes(since)
+    with game.db.unit_of_work():
+        game.apply_changes(changes)
+    return since
+
+
+def test_changes_reach_other_process(game, create_app):
+    other = Game(DB(create_app()))
+    since = game.db.backend.update_seq()
+    table = game.get_table('table')
+    player = game.get_player('alice')
+    with game.db.unit_of_work():
+        player.name = 'alicia'
+        new_table = game.add_table('another table')
+    since = follow(other, since)
+    assert other.get_player('alicia').id == player.id
+    assert not other.get_player('alice')
+    assert other.get_table('another table').id == new_table.id
+    assert other.tables[table.id].round.players == table.round.players
+    with game.db.unit_of_work():
+        game.delete_table(new_table.id)
+    follow(other, since)
+    assert new_table.id not in other.tables
+    assert not other.get_table('another table')
+
+
+def test_own_changes_are_skipped(game):
+    since = game.db.backend.update_seq()
+    player = game.get_player('bob')
+    with game.db.unit_of_work():
+        player.is_admin = True
+    before = dict(player)
+    follow(game, since)
+    assert game.get_player('bob') is player
+    assert dict(player) == before
+
+
+def test_changes_of_played_tricks(game, create_app):
+    other = Game(DB(create_app()))
+    since = game.db.backend.update_seq()
+    round = game.get_table('table').round
+    with game.db.unit_of_work():
+        for turn in range(4):
+            player = game.players[round.current_player_id]
+            round.add_turn(player.id, player.cards[0])
+            player.remove_card(player.cards[0])
+            round.get_current_player_id()
+        round.take_trick(round.players[0])
+    follow(other, since)
+    round_other = other.get_table('table').round
+    # counters of rebuilt round fit to the tricks it got
+    assert round_other.trick_count == 1
+    assert round_other.played_cards == round.played_cards
+    assert round_other.stats == round.stats
@@ -0,0 +1,177 @@
+from time import time
+
+import pytest
+
+from doko3000.database import DB, \
+    StorageUnavailable
+from doko3000.game import Game
+
+
+def stored(couchdb, db, document_id):
+    """
+    document as the fake CouchDB has it
+    """
+    return couchdb.databases[db.backend.database.database_name]['documents'].get(document_id)
+
+
+def test_unit_of_work_writes_once(game, couchdb):
+    player = game.get_player('alice')
+    couchdb.counts.clear()
+    with game.db.unit_of_work():
+        player.name = 'alicia'
+        player.is_admin = True
+        player.save()
+    assert sum(couchdb.counts.values()) == 1
+    assert stored(couchdb, game.db, player.id)['name'] == 'alicia'
+
+
+def test_write_behind_journals_first(create_app, couchdb):
+    game = Game(DB(create_app(WRITE_BEHIND=True)))
+    player = game.add_player(name='eve', password='eve')
+    # nothing reached CouchDB yet but the journal knows it
+    assert stored(couchdb, game.db, player.id) is None
+    assert player.id in game.db.write_behind.path.read_text()
+    assert game.db.write_behind.flush()
+    assert stored(couchdb, game.db, player.id)['name'] == 'eve'
+    assert game.db.write_behind.path.read_text() == ''
+
+
+def test_write_behind_replays_journal(create_app, couchdb):
+    app = create_app(WRITE_BEHIND=True)
+    game = Game(DB(app))
+    player = game.add_player(name='eve', password='eve')
+    # a crash before the background write leaves the journal - next start writes it
+    game = Game(DB(app))
+    assert stored(couchdb, game.db, player.id)['name'] == 'eve'
+    assert game.get_player('eve').id == player.id
+
+
+def test_documents_load_in_one_pass(game, create_app, couchdb):
+    couchdb.counts.clear()
+    loaded = Game(DB(create_app()))
+    assert set(loaded.players) == set(game.players)
+    assert [x for x in couchdb.counts if x.endswith('_all_docs')] == [f'GET {game.db.backend.database.database_name}/_all_docs']
+    assert couchdb.counts[f'GET {game.db.backend.database.database_name}/_all_docs'] == 1
+
+
+def test_sqlite_backend_keeps_game(create_app, tmp_path):
+    app = create_app(DATABASE_BACKEND='sqlite',
+                     SQLITE_PATH=str(tmp_path / 'doko3000.sqlite'))
+    game = Game(DB(app))
+    table = game.add_table('table')
+    for name in ['alice', 'bob', 'carol', 'dave', 'eve']:
+        table.add_player(game.add_player(name=name, password=name).id)
+    table.start()
+    with game.db.unit_of_work():
+        game.delete_player(game.get_player('eve').id)
+    loaded = Game(DB(app))
+    assert set(loaded.players) == set(game.players)
+    assert not loaded.get_player('eve')
+    assert loaded.tables[table.id].round.players == table.round.players
+    assert all(loaded.players[x].cards == game.players[x].cards for x in table.round.players)
+
+
+def test_compaction_after_many_writes(create_app, couchdb):
+    db = DB(create_app(COMPACTION_INTERVAL=60, COMPACTION_WRITES=10))
+    db.maintenance.min_file_size = 0
+    game = Game(db)
+    game.add_player(name='eve', password='eve')
+    db.maintenance.check()
+    assert not db.maintenance.history
+    for number in range(10):
+        game.add_table(f'table {number}')
+    couchdb.counts.clear()
+    db.maintenance.check()
+    assert couchdb.counts[f'POST {db.backend.database.database_name}/_compact'] == 1
+    assert db.maintenance.history[-1]['reason'].endswith(' writes')
+    assert db.maintenance.writes_since_compaction == 0
+
+
+def test_unreachable_storage_queues_writes(game, couchdb):
+    db = game.db
+    player = game.get_player('bob')
+    couchdb.down = True
+    with db.unit_of_work():
+        player.name = 'bobby'
+    assert player.id in db.queued
+    assert db.health()['status'] == 'degraded'
+    couchdb.down = False
+    db.replay_queued()
+    assert not db.queued
+    assert stored(couchdb, db, player.id)['name'] == 'bobby'
+
+
+def test_breaker_opens_and_reads_fail(create_app, couchdb):
+    db = DB(create_app(STORAGE_FAILURE_THRESHOLD=1, STORAGE_RETRIES=0))
+    couchdb.down = True
+    with pytest.raises(StorageUnavailable):
+        db.load_document('player-1')
+    assert db.breaker.state == 'open'
+    # no details of the error are given away
+    assert db.breaker.status()['last_error'] == 'HTTPError'
+    couchdb.down = False
+    # open breaker does not even try
+    with pytest.raises(StorageUnavailable):
+        db.load_document('player-1')
+
+
+def test_missing_document_is_none(game):
+    assert game.db.load_document('player-404') is None
+
+
+def test_conflict_takes_stored_document(create_app, couchdb):
+    app = create_app()
+    game1 = Game(DB(app))
+    game2 = Game(DB(app))
+    player1 = game1.add_player(name='eve', password='eve')
+    with game2.db.unit_of_work():
+        game2.apply_changes([{'id': player1.id,
+                              'changes': [{'rev': player1['_rev']}],
+                              'doc': dict(player1)}])
+    player2 = game2.players[player1.id]
+    player2.is_admin = True
+    player2.save()
+    # process 1 does not know about the change and writes an outdated revision
+    with game1.db.unit_of_work():
+        player1['is_spectator_only'] = True
+        player1.save()
+    assert not game1.db.queued
+    # change of process 2 survived and replaced the outdated one in process 1
+    assert stored(couchdb, game1.db, player1.id)['is_admin'] is True
+    assert player1.is_admin is True
+    assert player1['_rev'] == stored(couchdb, game1.db, player1.id)['_rev']
+
+
+def test_fake_couchdb_injects_latency_and_errors(game, couchdb):
+    player = game.get_player('alice')
+    couchdb.latency = 0.05
+    time_start = time()
+    assert game.db.load_document(player.id)['name'] == 'alice'
+    assert time() - time_start >= 0.05
+    couchdb.latency = 0.0
+    couchdb.error_rate = 1.0
+    with game.db.unit_of_work():
+        player.name = 'alicia'
+    # every retry failed too, so the write waits for storage coming back
+    assert player.id in game.db.queued
+    couchdb.error_rate = 0.0
+    game.db.replay_queued()
+    assert stored(couchdb, game.db, player.id)['name'] == 'alicia'
+
+
+def test_ids_are_unique_across_processes(create_app):
+    app = create_app(CHANGES_FEED=True)
+    game1 = Game(DB(app))
+    game2 = Game(DB(app))
+    player1 = game1.add_player(name='eve', password='eve')
+    player2 = game2.add_player(name='frank', password='frank')
+    assert player1.id != player2.id
+
+
+def test_id_counter_goes_with_unit_of_work(game, couchdb):
+    couchdb.counts.clear()
+    with game.db.unit_of_work():
+        player = game.add_player(name='eve', password='eve')
+    # counter and player are written together
+    assert sum(couchdb.counts.values()) == 1
+    assert stored(couchdb, game.db, 'ids')['player'] == int(player.id.split('-')[1])
@@ -0,0 +1,233 @@
+from time import sleep
+from types import SimpleNamespace
+
+from doko3000 import game as game_module
+from doko3000.database import DB
+from doko3000.game import Deck, \
+    Game, \
+    Rules
+
+
+def play_trick(round):
+    """
+    let every player of round play the first card of hand into current trick
+    """
+    for turn in range(4):
+        player = round.game.players[round.current_player_id]
+        card_id = player.cards[0]
+        round.add_turn(player.id, card_id)
+        player.remove_card(card_id)
+        round.get_current_player_id()
+
+
+def test_embedded_tricks_survive_reload(create_game, create_app, couchdb):
+    game = create_game(EMBED_TRICKS=True)
+    round = game.get_table('table').round
+    play_trick(round)
+    round.take_trick(round.players[1])
+    # tricks are no documents of their own
+    documents = couchdb.databases[game.db.backend.database.database_name]['documents']
+    assert not [x for x in documents if x.startswith('trick-')]
+    assert len(documents[f'round-{round.id}']['tricks']) == 12
+    loaded = Game(DB(create_app(EMBED_TRICKS=True))).tables[round.id].round
+    assert loaded.trick_count == 1
+    assert loaded.tricks[1].owner == round.players[1]
+    assert loaded.tricks[1].cards == round.tricks[1].cards
+    assert len(loaded.tricks[1].cards) == 4
+
+
+def test_rounds_load_when_accessed(game, create_app):
+    table_id = game.get_table('table').id
+    loaded = Game(DB(create_app()), table_idle_timeout=60)
+    assert not loaded.rounds.is_loaded(table_id)
+    assert loaded.tables[table_id].round.players == game.rounds[table_id].players
+    assert loaded.rounds.is_loaded(table_id)
+
+
+def test_idle_rounds_get_evicted(game):
+    table = game.get_table('table')
+    players = table.round.players
+    game.table_idle_timeout = 0.01
+    sleep(0.02)
+    # somebody still sitting there keeps the round
+    game.evict_idle_rounds({players[0]})
+    assert game.rounds.is_loaded(table.id)
+    game.evict_idle_rounds(set())
+    assert not game.rounds.is_loaded(table.id)
+    assert not [x for x in game.tricks if x.startswith(f'{table.id}-')]
+    # next access brings it back
+    assert table.round.players == players
+    assert game.rounds.is_loaded(table.id)
+
+
+def test_rounds_being_written_stay(game):
+    table = game.get_table('table')
+    game.table_idle_timeout = 0.01
+    sleep(0.02)
+    game.db.saving.add(f'round-{table.id}')
+    game.evict_idle_rounds(set())
+    assert game.rounds.is_loaded(table.id)
+
+
+def test_snapshot_restores_game_and_later_changes(game, create_app, couchdb, tmp_path):
+    game.snapshot_path = tmp_path / 'doko3000.snapshot'
+    game.save_snapshot()
+    round = game.get_table('table').round
+    with game.db.unit_of_work():
+        play_trick(round)
+        round.take_trick(round.players[2])
+        game.add_player(name='eve', password='eve')
+    couchdb.counts.clear()
+    restored = Game(DB(create_app()), snapshot_path=str(game.snapshot_path))
+    assert not [x for x in couchdb.counts if x.endswith('_all_docs')]
+    # the snapshot did not know eve and the trick yet, the changes feed did
+    assert restored.get_player('eve').id == game.get_player('eve').id
+    round_restored = restored.get_table('table').round
+    assert round_restored.trick_count == 1
+    assert round_restored.tricks[1].owner == round.players[2]
+    assert all(restored.players[x].cards == game.players[x].cards for x in round.players)
+    assert round_restored.game is restored
+
+
+def test_hand_mask_follows_cards(game):
+    player = game.get_player('alice')
+    cards = list(player.cards)
+    assert player.get_cards_mask() == sum(1 << x for x in cards)
+    assert player.has_cards(cards[::-1])
+    assert not player.has_cards(cards[1:])
+    assert not player.has_cards(cards[1:] + cards[1:2])
+    # whatever a client sends that is no card does not match
+    assert not player.has_cards(cards[1:] + [-1])
+    assert not player.has_cards(cards[1:] + ['1'])
+    player.remove_card(cards[0])
+    assert player.get_cards_mask() == Deck.get_mask(cards[1:])
+    # cards put back by undo
+    player.cards += cards[:1]
+    assert player.has_cards(cards)
+    # cards changed by another process
+    player.update(cards=cards[2:])
+    assert player.get_cards_mask() == Deck.get_mask(cards[2:])
+
+
+def test_dealt_eichel_ober_get_counted(game):
+    for player_id in game.get_table('table').round.players:
+        player = game.players[player_id]
+        assert player.eichel_ober_count == len([x for x in player.cards if Deck.cards[x].name == 'Eichel-Ober'])
+
+
+def test_counters_follow_turns_and_tricks(game):
+    round = game.get_table('table').round
+    play_trick(round)
+    assert len(round.played_cards) == 4
+    assert round.trick_count == 0
+    round.take_trick(round.players[1])
+    assert round.trick_count == 1
+    play_trick(round)
+    round.take_trick(round.players[2])
+    assert round.counters == round.get_counters()
+    assert round.stats == round.get_stats()
+
+
+def test_counters_survive_reload(game):
+    round = game.get_table('table').round
+    play_trick(round)
+    round.take_trick(round.players[1])
+    with game.db.unit_of_work():
+        round.save()
+    game_loaded = Game(game.db)
+    round_loaded = game_loaded.get_table('table').round
+    assert round_loaded.counters == round.counters
+    assert round_loaded.stats == round.stats
+
+
+def test_check_counters_tells_about_differences(game, monkeypatch, capsys):
+    monkeypatch.setattr(game_module, 'CHECK_COUNTERS', True)
+    round = game.get_table('table').round
+    play_trick(round)
+    assert 'ERROR' not in capsys.readouterr().out
+    round.counters['played_cards'].pop()
+    round.check_counters()
+    assert f'ERROR {round.id} counters' in capsys.readouterr().out
+
+
+def test_stats_move_with_reclaimed_trick(game):
+    round = game.get_table('table').round
+    play_trick(round)
+    round.take_trick(round.players[0])
+    value = round.stats['score'][round.players[0]]
+    # ownership of last trick was not clear - it goes to another player
+    round.set_trick_owner(round.trick_count, round.players[3])
+    assert round.stats['score'][round.players[0]] == 0
+    assert round.stats['score'][round.players[3]] == value
+    assert round.stats['tricks'][round.players[3]] == 1
+    assert round.trick_count == 1
+    assert round.stats == round.get_stats()
+
+
+def test_names_ignore_case(game):
+    assert game.get_player('ALICE') is game.get_player('alice')
+    assert not game.add_player(name='Alice', password='alice')
+    assert not game.add_table(name='TABLE')
+
+
+def test_deleted_player_leaves_no_traces(game):
+    table = game.get_table('table')
+    player = game.get_player('dave')
+    with game.db.unit_of_work():
+        assert game.delete_player(player.id)
+    assert player.id not in table.players
+    assert player.id not in table.order
+    assert player.id not in table.round.players
+    assert not game.get_player('dave')
+    # stored state knows it too
+    game_loaded = Game(game.db)
+    assert not game_loaded.get_player('dave')
+
+
+def test_deleting_player_does_not_load_evicted_rounds(game, couchdb):
+    table = game.get_table('table')
+    player = game.get_player('dave')
+    game.table_idle_timeout = 0.01
+    sleep(0.02)
+    game.evict_idle_rounds(set())
+    with game.db.unit_of_work():
+        assert game.delete_player(player.id)
+    assert not game.rounds.is_loaded(table.id)
+    documents = couchdb.databases[game.db.backend.database.database_name]['documents']
+    assert player.id not in documents[f'round-{table.id}']['players']
+    assert player.id not in documents[table.id]['players']
+
+
+def test_deleting_player_copes_with_unreachable_storage(game, couchdb):
+    player = game.get_player('dave')
+    game.table_idle_timeout = 0.01
+    sleep(0.02)
+    game.evict_idle_rounds(set())
+    couchdb.down = True
+    with game.db.unit_of_work():
+        assert game.delete_player(player.id)
+    assert not game.get_player('dave')
+
+
+def test_rules_follow_suit():
+    cards = {x.name: x.id for x in Deck.cards.values()}
+    hand = Deck.get_mask([cards['Schell-Ass'], cards['Herz-König']])
+    # any card may start a trick
+    assert Rules.is_legal(cards['Schell-Ass'], hand, [])
+    # Herz has to be followed by Herz if there is one...
+    assert not Rules.is_legal(cards['Schell-Ass'], hand, [cards['Herz-Ass']])
+    assert Rules.is_legal(cards['Herz-König'], hand, [cards['Herz-Ass']])
+    # ...while Ober are trumps and no Herz at all
+    hand = Deck.get_mask([cards['Herz-Ober'], cards['Schell-Ass']])
+    assert Rules.is_legal(cards['Herz-Ober'], hand, [cards['Herz-Ass']])
+
+
+def test_rules_winner():
+    cards = {x.name: x.id for x in Deck.cards.values()}
+    trick = SimpleNamespace(players=['player-1', 'player-2', 'player-3', 'player-4'])
+    # highest card of first suit wins
+    trick.cards = [cards['Grün-König'], cards['Grün-Ass'], cards['Eichel-Ass'], cards['Grün-Neun']]
+    assert Rules.get_winner(trick) == 'player-2'
+    # even the lowest trump beats everything else
+    trick.cards = [cards['Grün-Ass'], cards['Grün-Zehn'], cards['Schell-Neun'], cards['Grün-König']]
+    assert Rules.get_winner(trick) == 'player-3'
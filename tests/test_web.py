@@ -0,0 +1,223 @@
+from eventlet import sleep
+
+from doko3000.game import Deck, \
+    Rules
+
+
+def play(web, table, sockets, player_id, card_id):
+    """
+    let player play card like its browser does
+    """
+    player = web.game.players[player_id]
+    sockets[player_id].emit('card-played', {'player_id': player_id,
+                                            'table_id': table.id,
+                                            'card_id': card_id,
+                                            'cards_hand_ids': [x for x in player.cards if x != card_id]})
+
+
+def play_legal(web, table, sockets):
+    """
+    current player plays its first legal card
+    """
+    round = table.round
+    player = web.game.players[round.current_player_id]
+    card_id = next(x for x in player.cards if Rules.is_legal(x, player.get_cards_mask(), round.current_trick.cards))
+    play(web, table, sockets, player.id, card_id)
+
+
+def test_deleting_player_writes_once(web, seated, couchdb):
+    table, sockets = seated(start=False)
+    player = web.game.get_player('dave')
+    _, admin, _ = web.connect('admin')
+    couchdb.counts.clear()
+    response = admin.post(f'/delete/player/{player.id}', headers={'Accept': 'application/json'})
+    assert response.json == {'status': 'ok'}
+    # player and the table it left go to storage together
+    assert [x for x in couchdb.counts if x != 'GET _up'] == [f'POST {web.db.backend.database.database_name}/_bulk_docs']
+    assert couchdb.counts[f'POST {web.db.backend.database.database_name}/_bulk_docs'] == 1
+    assert player.id not in table.players
+
+
+def test_played_card_writes_once(web, seated, couchdb):
+    table, sockets = seated()
+    round = table.round
+    player = web.game.players[round.current_player_id]
+    card_id = player.cards[0]
+    couchdb.counts.clear()
+    sockets[player.id].emit('card-played', {'player_id': player.id,
+                                            'table_id': table.id,
+                                            'card_id': card_id,
+                                            'cards_hand_ids': player.cards[1:]})
+    assert round.current_trick.cards == [card_id]
+    # trick, hand, round and table of one turn go to storage together
+    assert [x for x in couchdb.counts if x != 'GET _up'] == [f'POST {web.db.backend.database.database_name}/_bulk_docs']
+    assert couchdb.counts[f'POST {web.db.backend.database.database_name}/_bulk_docs'] == 1
+
+
+def test_conflict_reloads_table(web, seated, couchdb):
+    table, sockets = seated()
+    round = table.round
+    # another process changed the round meanwhile
+    database = couchdb.databases[web.db.backend.database.database_name]
+    couchdb.store(database, dict(database['documents'][f'round-{table.id}'], is_reset=True))
+    player = web.game.players[round.current_player_id]
+    sockets[player.id].emit('card-played', {'player_id': player.id,
+                                            'table_id': table.id,
+                                            'card_id': player.cards[0],
+                                            'cards_hand_ids': player.cards[1:]})
+    assert web.game.rounds[table.id].is_reset is True
+    for socket in sockets.values():
+        assert {'path': f'/table/{table.id}'} in [x['args'][0] for x in socket.get_received()
+                                                  if x['name'] == 'redirect-to-path']
+
+
+
+def test_card_out_of_turn_is_ignored(web, seated):
+    table, sockets = seated(rules=True)
+    round = table.round
+    play_legal(web, table, sockets)
+    # the one after next is not on turn, no matter if the card would be legal or not
+    waiting_id = round.players[(round.players.index(round.current_player_id) + 1) % 4]
+    sockets[waiting_id].get_received()
+    turn_count = round.turn_count
+    for card_id in list(web.game.players[waiting_id].cards):
+        play(web, table, sockets, waiting_id, card_id)
+    assert round.turn_count == turn_count
+    assert sockets[waiting_id].get_received() == []
+
+
+def test_illegal_card_comes_back(web, seated):
+    table, sockets = seated(rules=True)
+    round = table.round
+    cards = {x.name: x.id for x in Deck.cards.values()}
+    first = web.game.players[round.current_player_id]
+    second = web.game.players[round.players[(round.players.index(first.id) + 1) % 4]]
+    first.cards = [cards['Herz-Ass']]
+    second.cards = [cards['Schell-Ass'], cards['Herz-König']]
+    play(web, table, sockets, first.id, cards['Herz-Ass'])
+    assert round.current_player_id == second.id
+    sockets[second.id].get_received()
+    turn_count = round.turn_count
+    # Herz has to be followed
+    play(web, table, sockets, second.id, cards['Schell-Ass'])
+    assert round.turn_count == turn_count
+    assert second.cards == [cards['Schell-Ass'], cards['Herz-König']]
+    assert [x['name'] for x in sockets[second.id].get_received()] == ['your-cards-please']
+    play(web, table, sockets, second.id, cards['Herz-König'])
+    assert round.turn_count == turn_count + 1
+
+
+def test_complete_trick_stays_visible(web, seated):
+    table, sockets = seated(rules=True)
+    round = table.round
+    for turn in range(4):
+        play_legal(web, table, sockets)
+    winner_id = Rules.get_winner(round.current_trick)
+    # everybody sees the 4 cards before the trick is taken away
+    assert round.trick_count == 0
+    assert len(round.current_trick.cards) == 4
+    sleep(0.2)
+    assert round.trick_count == 1
+    assert round.current_player_id == winner_id
+    assert 'next-trick' in [x['name'] for x in sockets[winner_id].get_received()]
+
+
+def test_health_tells_no_details(web):
+    assert web.app.test_client().get('/health').json == {'status': 'ok'}
+
+
+def test_dealt_cards_get_pushed(web, seated):
+    table, sockets = seated(start=False)
+    spectator, _, socket = web.connect('eve', f'/table/{table.id}')
+    socket.emit('enter-table', {'player_id': spectator.id, 'table_id': table.id})
+    spectator.is_spectator_only = True
+    sockets[spectator.id] = socket
+    for socket in sockets.values():
+        socket.get_received()
+    sockets[table.players[0]].emit('setup-table-change', {'action': 'start_table',
+                                                          'player_id': table.players[0],
+                                                          'table_id': table.id})
+    # nobody has to ask for cards, everybody got them right after dealing
+    for player_id, socket in sockets.items():
+        events = [x for x in socket.get_received() if x['name'] in ['your-cards-please', 'sorry-no-cards-for-you']]
+        assert len(events) == 1
+        if player_id == spectator.id:
+            assert events[0]['name'] == 'sorry-no-cards-for-you'
+        else:
+            assert events[0]['name'] == 'your-cards-please'
+            assert events[0]['args'][0]['player_id'] == player_id
+
+
+def test_state_deltas_leave_rendering_to_clients(web, seated, monkeypatch):
+    monkeypatch.setitem(web.app.config, 'STATE_DELTAS', True)
+    table, sockets = seated()
+    round = table.round
+    player = web.game.players[round.current_player_id]
+    card_id = player.cards[0]
+    play(web, table, sockets, player.id, card_id)
+    payload = next(x['args'][0] for x in sockets[player.id].get_received() if x['name'] == 'card-played-by-player')
+    assert payload['protocol'] == web.PROTOCOL_VERSION
+    assert payload['card_id'] == card_id
+    assert payload['player_name'] == player.name
+    assert 'html' not in payload
+    assert 'played_cards' not in payload
+    for turn in range(3):
+        player = web.game.players[round.current_player_id]
+        play(web, table, sockets, player.id, player.cards[0])
+    sockets[player.id].get_received()
+    sockets[player.id].emit('claim-trick', {'player_id': player.id, 'table_id': table.id})
+    payload = next(x['args'][0] for x in sockets[player.id].get_received() if x['name'] == 'next-trick')
+    assert payload['protocol'] == web.PROTOCOL_VERSION
+    assert payload['trick_order'] == round.trick_order
+    assert payload['tricks'][player.id] == 1
+    assert 'html' not in payload
+
+
+def test_fragments_are_rendered_once_per_state(web, seated):
+    table, sockets = seated()
+    with web.app.app_context():
+        table.forget_fragments()
+        counts = dict(web.fragment_counts)
+        html = web.render_fragment(table, 'top/hud_players.html')
+        assert web.render_fragment(table, 'top/hud_players.html') is html
+        assert web.fragment_counts['misses'] == counts['misses'] + 1
+        assert web.fragment_counts['hits'] == counts['hits'] + 1
+        assert html == web.render_template('top/hud_players.html', table=table, game=web.game, mode=None)
+        # shown player changed without a new sync count
+        web.game.get_player('alice').is_spectator_only = True
+        web.game.get_player('alice').is_spectator_only = False
+        assert web.render_fragment(table, 'top/hud_players.html') is not html
+        assert web.fragment_counts['misses'] == counts['misses'] + 2
+
+
+def test_card_fragments_equal_template(web, seated):
+    table, sockets = seated()
+    player = web.game.get_player('<b>"eve" & co</b>') or web.game.add_player(name='<b>"eve" & co</b>', password='x')
+    template = web.app.jinja_env.get_template('cards/card.html')
+    for card in Deck.cards.values():
+        for played_by in [None, player.id]:
+            for hand_spectator in [False, True]:
+                assert str(web.render_card(card, table, played_by, hand_spectator)) == \
+                       template.render(card=card,
+                                       table=table,
+                                       game=web.game,
+                                       played_by=played_by,
+                                       hand_spectator=hand_spectator)
+
+
+def test_lobby_changes_get_pushed_once(web, monkeypatch):
+    monkeypatch.setitem(web.app.config, 'LOBBY_DEBOUNCE', 0.05)
+    _, _, socket = web.connect('alice')
+    _, _, socket_admin = web.connect('admin')
+    for client in [socket, socket_admin]:
+        client.emit('enter-lobby')
+        client.get_received()
+    # a burst of changes
+    for number in range(3):
+        web.lobby_changed('tables')
+    web.lobby_changed('players')
+    sleep(0.2)
+    events = [x['args'][0]['table'] for x in socket.get_received() if x['name'] == 'index-list-changed']
+    assert events == ['tables']
+    events = [x['args'][0]['table'] for x in socket_admin.get_received() if x['name'] == 'index-list-changed']
+    assert sorted(events) == ['players', 'tables']